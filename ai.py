@@ -1,101 +1,428 @@
+import time
+import multiprocessing as mp
 import numpy as np
 from collections import defaultdict
-from operator import itemgetter
-from quoridor import encode_loc
+from concurrent.futures import ProcessPoolExecutor
+from quoridor import Quoridor, encode_loc, parse_loc
 INFINITY = 1e9
 
+# Bound types of values stored in a TranspositionTable. EXACT values are the true minimax value of the position to the
+# stored depth, LOWER values are from a beta cutoff (the true value is at least as high), and UPPER values are from
+# searches that failed to raise alpha (the true value is at most as high).
+EXACT, LOWER, UPPER = 0, 1, 2
 
-def alphabeta_search(game, eval_fn, max_depth=4):
+
+class TranspositionTable(object):
+    """A fixed-size table of search results keyed by state hash.
+
+    The table has 'size' buckets, each with two slots. New results for a bucket go into the 'depth-preferred' slot if
+    they were searched at least as deeply as what is there, and otherwise into the 'always-replace' slot. This keeps
+    the expensive deep results around while still remembering recent shallow ones.
+
+    Each entry is a tuple of (key, depth, value, bound, best_move), where depth is the number of plies searched below
+    the position and bound is one of EXACT, LOWER or UPPER.
+    """
+
+    def __init__(self, size=2**16):
+        self.size = size
+        self._deep = [None] * size
+        self._recent = [None] * size
+        self.hits = 0
+        self.misses = 0
+
+    def probe(self, key):
+        """Return the entry stored for 'key', or None if there is none.
+        """
+        bucket = hash(key) % self.size
+        for entry in (self._deep[bucket], self._recent[bucket]):
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, bound, best_move):
+        """Record the result of searching the position 'key' to the given depth.
+        """
+        bucket = hash(key) % self.size
+        entry = (key, depth, value, bound, best_move)
+        deep = self._deep[bucket]
+        if deep is None or deep[0] == key or depth >= deep[1]:
+            self._deep[bucket] = entry
+        else:
+            self._recent[bucket] = entry
+
+    def clear(self):
+        self._deep = [None] * self.size
+        self._recent = [None] * self.size
+        self.hits = 0
+        self.misses = 0
+
+
+class MoveOrdering(object):
+    """Decides the order in which alphabeta_search tries moves. This base class tries the transposition table's best
+    move first and the rest in the order generated. Subclasses may override order() and learn from cutoff().
+    """
+
+    def order(self, game, ply, first_move):
+        """Generate the legal moves in 'game' in the order to search them. 'ply' is the number of moves since the root
+        and 'first_move' is the best move remembered for this position, or None.
+
+        This is a generator so that the legality of walls is only checked when they are about to be searched (see
+        Quoridor.iter_legal_walls); the search makes and undoes moves between steps.
+        """
+        if first_move is not None and game.is_legal(first_move):
+            yield first_move
+        for mv in game.iter_legal_moves():
+            if mv != first_move:
+                yield mv
+
+    def cutoff(self, mv, ply, remaining):
+        """Called when 'mv' caused a beta cutoff at the given ply with 'remaining' plies left to search below it.
+        """
+        pass
+
+
+class HeuristicOrdering(MoveOrdering):
+    """Orders moves as: the transposition table move, pawn steps along a shortest path, killer moves (recent moves that
+    caused a cutoff at the same ply), walls by history score (total remaining depth squared of the cutoffs they
+    caused anywhere in the tree), and finally the other pawn moves.
+
+    Killers and history persist for the lifetime of the object, so they carry over between the iterations of an
+    iterative deepening search.
+    """
+
+    def __init__(self, n_killers=2):
+        self.n_killers = n_killers
+        self.killers = defaultdict(list)
+        self.history = defaultdict(int)
+
+    def order(self, game, ply, first_move):
+        if first_move is not None and game.is_legal(first_move):
+            yield first_move
+        graph = game.get_graph()
+        distance = graph.get_distance(game.get_player()[0])
+        shortest, pawns = [], []
+        for mv in game.legal_pawn_moves():
+            if mv != first_move:
+                (shortest if graph.get_distance(parse_loc(mv)) < distance else pawns).append(mv)
+        for mv in shortest:
+            yield mv
+        searched = set([first_move]) | set(shortest)
+        for mv in self.killers[ply]:
+            if mv not in searched and game.is_legal(mv):
+                searched.add(mv)
+                yield mv
+        history = self.history
+        for mv in game.iter_legal_walls(key=lambda wall: -history.get(wall, 0)):
+            if mv not in searched:
+                yield mv
+        for mv in pawns:
+            if mv not in searched:
+                yield mv
+
+    def cutoff(self, mv, ply, remaining):
+        killers = self.killers[ply]
+        if mv not in killers:
+            killers.insert(0, mv)
+            del killers[self.n_killers:]
+        if len(mv) == 3:
+            self.history[mv] += remaining * remaining
+
+
+class SearchStats(object):
+    """Counts of the work done by alphabeta_search. 'nodes' and 'plies' describe the deepest completed iteration.
+    """
+
+    def __init__(self):
+        self.nodes = 0
+        self.plies = 0
+
+    @property
+    def effective_branching_factor(self):
+        """The branching factor b of a uniform tree with b**plies nodes, i.e. how many moves per position the search
+        effectively had to look at. Perfect move ordering gives about the square root of the number of legal moves.
+        """
+        return self.nodes ** (1.0 / self.plies) if self.plies > 0 else 0.0
+
+
+class SearchTimeout(Exception):
+    """Raised inside a search when its deadline has passed.
+    """
+    pass
+
+
+def alphabeta_search(game, eval_fn, max_depth=4, tt=None, time_budget_ms=None, ordering=None, stats=None,
+                     n_workers=1):
     """Search game to determine best action; use alpha-beta pruning.
     This version cuts off search and uses an evaluation function.
 
     The evaluation function must take in (game, whose_perspective)
     as its arguments.
 
+    Results are stored in the TranspositionTable 'tt' so that positions reached by different move orders (for example
+    the same walls placed in a different order) are only searched once. Pass the same table to later calls to reuse
+    their work; by default a new table is used for each search.
+
+    If time_budget_ms is given, the search is iterative deepening: it searches 1 ply, then max_depth=0 (2 plies),
+    max_depth=1, and so on up to max_depth, and returns the best move of the deepest iteration that finished within
+    the budget. Each iteration tries the best moves found by the previous one first (via the table). The 1-ply
+    iteration always runs to completion so that there is a move to return.
+
+    'ordering' is the MoveOrdering that decides which moves to try first (a new HeuristicOrdering by default), and if
+    a SearchStats object is given as 'stats', it is filled in with the size of the search.
+
+    If n_workers > 1, root moves are searched in parallel by a pool of that many processes (see _parallel_alphabeta).
+    eval_fn must then be picklable, i.e. a module-level function rather than a lambda.
+
     Modified from http://aima.cs.berkeley.edu/python/games.html
     """
+    if tt is None:
+        tt = TranspositionTable()
+    if ordering is None:
+        ordering = HeuristicOrdering()
+    if stats is None:
+        stats = SearchStats()
+    if n_workers > 1:
+        shared_alpha = mp.Value('d', -INFINITY)
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(shared_alpha,)) as pool:
+            def search(depth, deadline=None):
+                return _parallel_alphabeta(game, eval_fn, depth, tt, ordering, stats, pool, shared_alpha, deadline)
+            return _deepen(search, max_depth, time_budget_ms)
+    else:
+        def search(depth, deadline=None):
+            return _alphabeta(game, eval_fn, depth, tt, ordering, stats, deadline)[1]
+        return _deepen(search, max_depth, time_budget_ms)
+
+
+def _deepen(search, max_depth, time_budget_ms):
+    """Call search(depth) at max_depth, or with iterative deepening if time_budget_ms is given (see alphabeta_search).
+    """
+    if time_budget_ms is None:
+        return search(max_depth)
+
+    # A monotonic clock, so that adjustments of the system clock do not cut an iteration short or let it overrun. It is
+    # system-wide, so the deadline also holds in the worker processes of _parallel_alphabeta.
+    deadline = time.monotonic() + time_budget_ms / 1000.0
+    best_move = search(-1)
+    for depth in range(max_depth + 1):
+        try:
+            best_move = search(depth, deadline)
+        except SearchTimeout:
+            break
+    return best_move
+
+
+def _alphabeta(game, eval_fn, max_depth, tt, ordering, stats, deadline=None, root_moves=None, alpha=-INFINITY):
+    """A single fixed-depth alphabeta search (see alphabeta_search), which raises SearchTimeout if the time.monotonic()
+    deadline is given and passes before it is done. Returns a tuple of (value, best move).
+
+    If root_moves is given, only those moves are searched at the root, with a lower bound of 'alpha' on the root value.
+    The returned value is then exact if it is greater than alpha, and otherwise just an upper bound.
+    """
     player = game.current_player
+    # Count nodes locally so that stats only ever describe complete iterations.
+    nodes = [0]
 
     def cutoff_test(game, depth):
         return (depth > max_depth) or (game.get_winner() is not None)
 
-    def max_value(game, alpha, beta, depth, visited):
+    def value(game, alpha, beta, depth):
+        nodes[0] += 1
         if cutoff_test(game, depth):
             return eval_fn(game, player)
-        v = -INFINITY
-        for mv in game.all_legal_moves():
-            with game.temp_move(mv):
-                hsh = hash(game)
-                if hsh in visited:
-                    continue
+        if deadline is not None and time.monotonic() > deadline:
+            raise SearchTimeout()
+        # Values are from the perspective of 'player', so the key includes it in case the table is reused by a search
+        # for the other player. 'remaining' is the number of plies left to search below this position.
+        key, remaining = (game.hash_key(), player), max_depth + 1 - depth
+        entry = tt.probe(key)
+        tt_move = None
+        if entry is not None:
+            _, entry_depth, entry_value, bound, tt_move = entry
+            if entry_depth >= remaining:
+                if bound == EXACT:
+                    return entry_value
+                elif bound == LOWER:
+                    alpha = max(alpha, entry_value)
                 else:
-                    visited.add(hsh)
-                v = max(v, min_value(game, alpha, beta, depth + 1, visited))
-                if v >= beta:
-                    return v
-                alpha = max(alpha, v)
-        return v
-
-    def min_value(game, alpha, beta, depth, visited):
-        if cutoff_test(game, depth):
-            return eval_fn(game, player)
-        v = INFINITY
-        for mv in game.all_legal_moves():
+                    beta = min(beta, entry_value)
+                if alpha >= beta:
+                    return entry_value
+        alpha_orig, beta_orig = alpha, beta
+        maximizing = game.current_player == player
+        v, best_move = (-INFINITY if maximizing else INFINITY), None
+        for mv in ordering.order(game, depth + 1, tt_move):
             with game.temp_move(mv):
-                hsh = hash(game)
-                if hsh in visited:
-                    continue
-                else:
-                    visited.add(hsh)
-                v = min(v, max_value(game, alpha, beta, depth + 1, visited))
-                if v <= alpha:
-                    return v
+                child_value = value(game, alpha, beta, depth + 1)
+            if maximizing and child_value > v or not maximizing and child_value < v:
+                v, best_move = child_value, mv
+            if maximizing:
+                alpha = max(alpha, v)
+            else:
                 beta = min(beta, v)
+            if alpha >= beta:
+                ordering.cutoff(mv, depth + 1, remaining)
+                break
+        bound = LOWER if v >= beta_orig else UPPER if v <= alpha_orig else EXACT
+        tt.store(key, remaining, v, bound, best_move)
         return v
 
-    visited = set([hash(game)])
-
-    # Body of alphabeta_search starts here:
-    best = (-INFINITY, None)
-    for mv in game.all_legal_moves():
+    # Body of _alphabeta starts here:
+    best = (alpha, None)
+    # Only a search of all root moves gives the exact value of the root.
+    full_root = root_moves is None
+    if full_root:
+        entry = tt.probe((game.hash_key(), player))
+        root_moves = ordering.order(game, 0, entry[4] if entry is not None else None)
+    for mv in root_moves:
         with game.temp_move(mv):
-            hsh = hash(game)
-            if hsh in visited:
-                continue
-            else:
-                visited.add(hsh)
-            v = min_value(game, -INFINITY, INFINITY, 0, visited)
-        if v > best[0]:
+            v = value(game, best[0], INFINITY, 0)
+        if v > best[0] or best[1] is None:
             best = (v, mv)
-    return mv
+    if full_root:
+        tt.store((game.hash_key(), player), max_depth + 2, best[0], EXACT, best[1])
+    stats.nodes, stats.plies = nodes[0], max_depth + 2
+    return best
+
+
+def _parallel_alphabeta(game, eval_fn, max_depth, tt, ordering, stats, pool, shared_alpha, deadline=None):
+    """Root-parallel version of _alphabeta (returning just the best move) that uses the 'young brothers wait' scheme.
+
+    The first root move is searched here to get an exact value for alpha. The remaining root moves are then farmed
+    out to the ProcessPoolExecutor 'pool', whose workers were started by _init_worker with the multiprocessing.Value
+    'shared_alpha'. Workers receive a compact snapshot of the game rather than a pickled Quoridor object, and publish
+    each improvement of the root value through shared_alpha, so that tasks started later search with a tighter window.
+    """
+    entry = tt.probe((game.hash_key(), game.current_player))
+    root_moves = list(ordering.order(game, 0, entry[4] if entry is not None else None))
+    best = _alphabeta(game, eval_fn, max_depth, tt, ordering, stats, deadline, root_moves=root_moves[:1])
+    nodes = stats.nodes
+    with shared_alpha.get_lock():
+        shared_alpha.value = best[0]
+    snapshot = game.snapshot()
+    futures = [pool.submit(_search_root_move, snapshot, mv, eval_fn, max_depth, deadline) for mv in root_moves[1:]]
+    try:
+        # Results are combined in root move order, and only strict improvements count, so ties go to the move that
+        # was ordered first, as in the serial search. A move that failed low only has an upper bound on its value, at
+        # most the alpha it was searched with, which is the exact value of some other root move, so it never replaces
+        # the best move.
+        fail_lows = []
+        for future in futures:
+            v, mv, exact, worker_nodes = future.result()
+            nodes += worker_nodes
+            if exact and v > best[0]:
+                best = (v, mv)
+            elif not exact:
+                fail_lows.append((v, mv))
+    except SearchTimeout:
+        for future in futures:
+            future.cancel()
+        raise
+    # But a move can fail low against the value of a later move that finished first, and tie with it. So moves ordered
+    # before the best one whose bound reaches the best value are searched again with an open window, in root order,
+    # and the first that ties takes the best move's place.
+    best_index = root_moves.index(best[1])
+    for v, mv in fail_lows:
+        if root_moves.index(mv) < best_index and v >= best[0]:
+            v, _ = _alphabeta(game, eval_fn, max_depth, tt, ordering, stats, deadline, root_moves=[mv])
+            nodes += stats.nodes
+            if v >= best[0]:
+                best = (best[0], mv)
+                break
+    tt.store((game.hash_key(), game.current_player), max_depth + 2, best[0], EXACT, best[1])
+    stats.nodes, stats.plies = nodes, max_depth + 2
+    return best[1]
+
+
+# State of each worker process of _parallel_alphabeta, set by _init_worker. Workers keep their own transposition table
+# and move ordering for the lifetime of the pool, and cache the game of the most recent snapshot.
+_worker = {}
+
+
+def _init_worker(shared_alpha):
+    _worker['alpha'] = shared_alpha
+    _worker['tt'] = TranspositionTable()
+    _worker['ordering'] = HeuristicOrdering()
+    _worker['snapshot'], _worker['game'] = None, None
+
+
+def _search_root_move(snapshot, mv, eval_fn, max_depth, deadline):
+    """Task run by the workers of _parallel_alphabeta: search the root move 'mv' of the game in 'snapshot', returning
+    (value, mv, exact, number of nodes searched). If 'exact' is False the move failed low, and value is only an upper
+    bound on its true value.
+    """
+    if _worker['snapshot'] != snapshot:
+        _worker['snapshot'], _worker['game'] = snapshot, Quoridor.from_snapshot(snapshot)
+    shared_alpha, stats = _worker['alpha'], SearchStats()
+    with shared_alpha.get_lock():
+        alpha = shared_alpha.value
+    v, _ = _alphabeta(_worker['game'], eval_fn, max_depth, _worker['tt'], _worker['ordering'], stats, deadline,
+                      root_moves=[mv], alpha=alpha)
+    exact = v > alpha
+    if exact:
+        with shared_alpha.get_lock():
+            shared_alpha.value = max(shared_alpha.value, v)
+    return v, mv, exact, stats.nodes
 
 
-def monte_carlo_tree_search(game, eval_fn, policy_fn, max_depth=10, n_search=1000):
+def monte_carlo_tree_search(game, eval_fn, policy_fn, max_depth=10, n_search=1000, n_workers=1, seed=None):
     """Monte Carlo Tree Search, where moves are selected according to policy_fn, playouts go to a
        depth of max_depth, at which point states are evaluated with eval_fn (as defined in
        alphabeta_search). policy_fn must take in a 'game' and return a list of (mv, prob) tuples.
-    """
-    player = game.current_player
-    mv_scores = defaultdict(lambda: 0)
-    n_visit = defaultdict(lambda: 0)
 
+       If n_workers > 1, the n_search playouts are split over a pool of that many processes, each with its own random
+       generator seeded from 'seed', and their per-move score and visit totals are added up. eval_fn and policy_fn must
+       then be picklable, i.e. module-level functions rather than lambdas. A single process draws from its own generator
+       seeded from 'seed' too if one is given, and otherwise from the global numpy random state (see np.random.seed).
+    """
     # If all players are out of walls, simply step along the shortest path (careful about jumping
     # situations though).
     if sum(p[1] for p in game.players) == 0:
-        shortest_path = game.get_graph().get_path()
+        shortest_path = game.get_graph().get_path(game.get_player()[0])
         shortest_path_step = next(shortest_path)
-        mv = encode_loc(shortest_path_step)
+        mv = encode_loc(*shortest_path_step)
         if game.is_legal(mv):
             return mv
 
+    if n_workers > 1:
+        seeds = np.random.SeedSequence(seed).spawn(n_workers)
+        snapshot = game.snapshot()
+        counts = [n_search // n_workers + (1 if i < n_search % n_workers else 0) for i in range(n_workers)]
+        mv_scores, n_visit = defaultdict(lambda: 0), defaultdict(lambda: 0)
+        with ProcessPoolExecutor(n_workers) as pool:
+            futures = [pool.submit(_playouts_from_snapshot, snapshot, eval_fn, policy_fn, max_depth, n, s)
+                       for (n, s) in zip(counts, seeds)]
+            for future in futures:
+                worker_scores, worker_visits = future.result()
+                for mv in worker_visits:
+                    mv_scores[mv] += worker_scores[mv]
+                    n_visit[mv] += worker_visits[mv]
+    else:
+        rng = np.random if seed is None else np.random.default_rng(seed)
+        mv_scores, n_visit = _playouts(game, eval_fn, policy_fn, max_depth, n_search, rng)
+
+    # Choose max value move.
+    return max(mv_scores, key=lambda mv: mv_scores[mv] / n_visit[mv])
+
+
+def _playouts(game, eval_fn, policy_fn, max_depth, n_search, rng):
+    """Run n_search random playouts for monte_carlo_tree_search using the numpy Generator 'rng' (or the np.random
+    module, for the global random state). Returns a pair of dicts from each first move played to the sum of the scores
+    of its playouts and to the number of its playouts.
+    """
+    player = game.current_player
+    mv_scores = defaultdict(lambda: 0)
+    n_visit = defaultdict(lambda: 0)
+
     def sample_move(game):
         moves, probabilities = zip(*policy_fn(game))
         probabilities = [p / sum(probabilities) for p in probabilities]
-        choice_idx = np.random.choice(len(moves), p=probabilities)
+        choice_idx = rng.choice(len(moves), p=probabilities)
         while not game.is_legal(moves[choice_idx]):
             probabilities[choice_idx] = 0
             probabilities = [p / sum(probabilities) for p in probabilities]
-            choice_idx = np.random.choice(len(moves), p=probabilities)
+            choice_idx = rng.choice(len(moves), p=probabilities)
         return moves[choice_idx]
 
     def recursive_search(game, remaining_depth):
@@ -108,10 +435,47 @@ def monte_carlo_tree_search(game, eval_fn, policy_fn, max_depth=10, n_search=100
     for i in range(n_search):
         init_mv = sample_move(game)
         with game.temp_move(init_mv):
-            score = recursive_search(game, max_depth)
-            n = n_visit[init_mv]
-            mv_scores[init_mv] = (n_visit[init_mv] * mv_scores[init_mv] + score) / (n + 1.0)
+            mv_scores[init_mv] += recursive_search(game, max_depth)
             n_visit[init_mv] += 1
+    return dict(mv_scores), dict(n_visit)
 
-    # Choose max value move.
-    return max(mv_scores.items(), key=itemgetter(1))[0]
+
+def _playouts_from_snapshot(snapshot, eval_fn, policy_fn, max_depth, n_search, seed_sequence):
+    """Task run by the workers of monte_carlo_tree_search: _playouts on the game in 'snapshot'.
+    """
+    game = Quoridor.from_snapshot(snapshot)
+    return _playouts(game, eval_fn, policy_fn, max_depth, n_search, np.random.default_rng(seed_sequence))
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    from features import simple_value
+
+    # A fixed set of test positions: a few random openings.
+    rng = random.Random(0)
+    positions = []
+    for trial in range(2):
+        game = Quoridor()
+        for _ in range(6):
+            game.exec_move(rng.choice(sorted(game.all_legal_moves())))
+        positions.append(game)
+
+    # Compare the size of fixed-depth searches with and without move ordering.
+    for game in positions:
+        for ordering in [MoveOrdering(), HeuristicOrdering()]:
+            stats = SearchStats()
+            tstart = time.time()
+            mv = alphabeta_search(game, simple_value, max_depth=2, ordering=ordering, stats=stats)
+            print("%-18s best %-4s %7d nodes, effective branching factor %5.1f, %.2fs" %
+                  (type(ordering).__name__, mv, stats.nodes, stats.effective_branching_factor, time.time() - tstart))
+
+    # Speedup curve of root-parallel search over 1..N workers.
+    baseline = None
+    for n_workers in range(1, max(2, os.cpu_count() or 1) + 1):
+        tstart = time.time()
+        for game in positions:
+            alphabeta_search(game, simple_value, max_depth=2, n_workers=n_workers)
+        elapsed = time.time() - tstart
+        baseline = baseline or elapsed
+        print("%2d workers: %.2fs, speedup %.2f" % (n_workers, elapsed, baseline / elapsed))
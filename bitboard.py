@@ -0,0 +1,403 @@
+from quoridor import BOARD_SIZE, ALL_WALLS, INTERSECTING_WALLS, TOUCHING_WALLS, IllegalMove, parse_loc, encode_loc
+
+# Every square (row, col) of the board is assigned the bit (1 << (row * BOARD_SIZE + col)), so that sets of squares
+# are simply python ints. Wall slots reuse the id of their top-left square, so wall ids live on the same grid (walls
+# never occupy the last row or column).
+N_SQUARES = BOARD_SIZE * BOARD_SIZE
+FULL_BOARD = (1 << N_SQUARES) - 1
+ROW_MASK = (1 << BOARD_SIZE) - 1
+FIRST_ROW = ROW_MASK
+LAST_ROW = ROW_MASK << (N_SQUARES - BOARD_SIZE)
+FIRST_COL = sum(1 << (row * BOARD_SIZE) for row in range(BOARD_SIZE))
+LAST_COL = FIRST_COL << (BOARD_SIZE - 1)
+NOT_LAST_ROW = FULL_BOARD & ~LAST_ROW
+NOT_FIRST_COL = FULL_BOARD & ~FIRST_COL
+NOT_LAST_COL = FULL_BOARD & ~LAST_COL
+# Wall slots are all squares except those in the last row or column.
+ALL_WALL_SLOTS = NOT_LAST_ROW & NOT_LAST_COL
+
+# Goal masks, same ordering as quoridor.GOALS: player 0 heads for the last row and player 1 for the first.
+GOAL_MASKS = [LAST_ROW, FIRST_ROW]
+
+# Steps are indexed 0=up, 1=down, 2=left, 3=right. PERPENDICULAR gives the two 'diagonal' options for a blocked jump.
+STEP_DELTA = [-BOARD_SIZE, BOARD_SIZE, -1, 1]
+PERPENDICULAR = [(2, 3), (2, 3), (0, 1), (0, 1)]
+
+
+def square_id(row, col):
+    return row * BOARD_SIZE + col
+
+
+def iter_bits(mask):
+    """Generate the ids of all set bits in mask, lowest first.
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+# Lookup from move strings to (kind, id), where kind is 0 for pawn moves, 1 for horizontal walls and 2 for vertical
+# walls, and back again. This keeps string parsing out of exec_move and is_legal.
+MOVE_CODES = {}
+for _row in range(BOARD_SIZE):
+    for _col in range(BOARD_SIZE):
+        MOVE_CODES[encode_loc(_row, _col)] = (0, square_id(_row, _col))
+for _wall in ALL_WALLS:
+    MOVE_CODES[_wall] = (1 if _wall[2] == 'h' else 2, square_id(*parse_loc(_wall[:2])))
+MOVE_STRINGS = {code: mv for (mv, code) in MOVE_CODES.items()}
+
+
+def _slot_masks(walls):
+    """Split a collection of wall strings into (horizontal, vertical) slot bitmasks. Strings naming walls that are off
+    the board (TOUCHING_WALLS contains a few along the last row and column) are skipped.
+    """
+    masks = [0, 0, 0]
+    for wall in walls:
+        if wall in MOVE_CODES:
+            kind, idx = MOVE_CODES[wall]
+            masks[kind] |= 1 << idx
+    return (masks[1], masks[2])
+
+
+# For each wall slot, bitmasks of the horizontal and vertical slots it physically rules out once played (including
+# itself), and of those it touches. These are indexed by the (kind, id) pair from MOVE_CODES, so index 0 is unused.
+INTERSECTING_MASKS = [None, {}, {}]
+TOUCHING_MASKS = [None, {}, {}]
+for _wall in ALL_WALLS:
+    _kind, _id = MOVE_CODES[_wall]
+    INTERSECTING_MASKS[_kind][_id] = _slot_masks(INTERSECTING_WALLS[_wall])
+    TOUCHING_MASKS[_kind][_id] = _slot_masks(TOUCHING_WALLS[_wall])
+
+
+class BitboardQuoridor(object):
+    """Alternative Quoridor state engine with the same public API as quoridor.Quoridor, where all state is stored as
+    integer bitmasks over the 9x9 grid (see the module-level notes on square ids).
+
+    Walls are kept both as the placed slots (_hwalls, _vwalls) and as 'blocked step' masks: bit i of _block_down is
+    set when stepping from square i to the square below it is blocked, and bit i of _block_right likewise for stepping
+    right. Paths to goals are found by flood-filling a mask of reachable squares with shifts.
+    """
+
+    def __init__(self):
+        self._pawns = [square_id(0, BOARD_SIZE // 2), square_id(BOARD_SIZE - 1, BOARD_SIZE // 2)]
+        self._wall_counts = [10, 10]
+        self._hwalls = 0
+        self._vwalls = 0
+        self._open_h = ALL_WALL_SLOTS
+        self._open_v = ALL_WALL_SLOTS
+        self._block_down = 0
+        self._block_right = 0
+        # History holds (kind, id, prev) tuples. For pawn moves prev is the square the pawn left, and for walls it is
+        # the pair of open-slot masks from before the wall was played, so that undo is a pure restore.
+        self.history = []
+        self.redo_stack = []
+        self.current_player = 0
+
+    def __eq__(self, other):
+        return isinstance(other, BitboardQuoridor) and self.hash_key() == other.hash_key()
+
+    def __ne__(self, other):
+        return not(self == other)
+
+    def __hash__(self):
+        return hash(self.hash_key())
+
+    ###########################
+    # PUBLIC-FACING FUNCTIONS #
+    ###########################
+
+    @property
+    def players(self):
+        """List of [(row, col), num_walls] per player, matching the layout of Quoridor.players (a copy, not a view).
+        """
+        return [[divmod(pawn, BOARD_SIZE), count] for (pawn, count) in zip(self._pawns, self._wall_counts)]
+
+    @property
+    def walls(self):
+        """Set of wall strings that have been played, matching Quoridor.walls (a copy, not a view).
+        """
+        return set(MOVE_STRINGS[(1, i)] for i in iter_bits(self._hwalls)) | \
+            set(MOVE_STRINGS[(2, i)] for i in iter_bits(self._vwalls))
+
+    def exec_move(self, mv, check_legal=True, is_redo=False):
+        """Execute a move given as a string and update the state. See Quoridor.exec_move.
+        """
+        if check_legal and not self.is_legal(mv):
+            raise IllegalMove(mv)
+        kind, idx = MOVE_CODES[mv]
+        self._exec(kind, idx, is_redo)
+
+    def exec_move_idx(self, action_idx, check_legal=True, is_redo=False):
+        """Execute a move given by its action index (see quoridor.ACTION_INDEX). For this backend the action index is
+        simply kind * 81 + id, with kind and id as in MOVE_CODES.
+        """
+        if check_legal and not self.is_legal_idx(action_idx):
+            raise IllegalMove(action_idx)
+        kind, idx = divmod(action_idx, N_SQUARES)
+        self._exec(kind, idx, is_redo)
+
+    def temp_move(self, mv):
+        """Execute the given move in a `with` context, where it automatically undoes itself when
+           the `with` is complete.
+        """
+        return BitboardQuoridor.TempMove(self, mv)
+
+    def undo(self, allow_redo=True):
+        """Undo the last move.
+        """
+        if len(self.history) > 0:
+            prev_player = 1 - self.current_player
+            kind, idx, prev = self.history.pop()
+            if kind == 0:
+                self._pawns[prev_player] = prev
+            else:
+                self._wall_counts[prev_player] += 1
+                self._open_h, self._open_v = prev
+                self._remove(kind, idx)
+            if allow_redo:
+                self.redo_stack.append(MOVE_STRINGS[(kind, idx)])
+            self.current_player = prev_player
+
+    def redo(self):
+        """Play forward from series of calls to undo().
+        """
+        if len(self.redo_stack) > 0:
+            self.exec_move(self.redo_stack.pop(), is_redo=True)
+
+    def is_legal(self, mv):
+        """Return True iff the given move is legal.
+        """
+        code = MOVE_CODES.get(mv) if type(mv) is str else None
+        if code is None:
+            return False
+        kind, idx = code
+        if kind == 0:
+            return idx in self._pawn_destinations()
+        else:
+            return self._is_legal_wall(kind, idx)
+
+    def is_legal_idx(self, action_idx):
+        """Return True iff the move with the given action index is legal.
+        """
+        kind, idx = divmod(action_idx, N_SQUARES)
+        if (kind, idx) not in MOVE_STRINGS:
+            return False
+        elif kind == 0:
+            return idx in self._pawn_destinations()
+        else:
+            return self._is_legal_wall(kind, idx)
+
+    def get_winner(self):
+        """Return the index of the winning player, or None if nobody has won yet.
+        """
+        for i, pawn in enumerate(self._pawns):
+            if (GOAL_MASKS[i] >> pawn) & 1:
+                return i
+        return None
+
+    def all_legal_moves(self, partial_check=False):
+        legal_moves = [MOVE_STRINGS[(0, idx)] for idx in self._pawn_destinations()]
+        if self._wall_counts[self.current_player] == 0:
+            return legal_moves
+        for kind, open_slots in ((1, self._open_h), (2, self._open_v)):
+            for idx in iter_bits(open_slots):
+                if partial_check or self._is_legal_wall(kind, idx):
+                    legal_moves.append(MOVE_STRINGS[(kind, idx)])
+        return legal_moves
+
+    def legal_action_indices(self, partial_check=False):
+        """Same as all_legal_moves(), but returns action indices rather than strings.
+        """
+        legal_indices = self._pawn_destinations()
+        if self._wall_counts[self.current_player] == 0:
+            return legal_indices
+        for kind, open_slots in ((1, self._open_h), (2, self._open_v)):
+            for idx in iter_bits(open_slots):
+                if partial_check or self._is_legal_wall(kind, idx):
+                    legal_indices.append(kind * N_SQUARES + idx)
+        return legal_indices
+
+    def get_player(self, player_idx=None):
+        """Return the [(row, col), num_walls] state for the current player (or the player at index player_idx).
+
+        Unlike Quoridor.get_player, the returned list is a copy and modifying it does not change the game.
+        """
+        return self.players[self.current_player if player_idx is None else player_idx]
+
+    def hash_key(self):
+        """Create a unique identifier for the present state of the game (history-free).
+        """
+        return (self.current_player, self._hwalls, self._vwalls, self._pawns[0], self._pawns[1],
+                self._wall_counts[0], self._wall_counts[1])
+
+    ####################
+    # HELPER FUNCTIONS #
+    ####################
+
+    def _exec(self, kind, idx, is_redo):
+        """Shared body of exec_move and exec_move_idx, for a move already decoded into (kind, id).
+        """
+        player = self.current_player
+        if kind == 0:
+            self.history.append((0, idx, self._pawns[player]))
+            self._pawns[player] = idx
+        else:
+            self.history.append((kind, idx, (self._open_h, self._open_v)))
+            self._wall_counts[player] -= 1
+            rule_out_h, rule_out_v = INTERSECTING_MASKS[kind][idx]
+            self._open_h &= ~rule_out_h
+            self._open_v &= ~rule_out_v
+            self._place(kind, idx)
+        self.current_player = 1 - player
+        if not is_redo:
+            self.redo_stack = []
+
+    def _place(self, kind, idx):
+        """Add the wall to the placed-wall and blocked-step masks.
+        """
+        if kind == 1:
+            self._hwalls |= 1 << idx
+            self._block_down |= 3 << idx
+        else:
+            self._vwalls |= 1 << idx
+            self._block_right |= (1 << idx) | (1 << (idx + BOARD_SIZE))
+
+    def _remove(self, kind, idx):
+        """Inverse of _place.
+        """
+        if kind == 1:
+            self._hwalls &= ~(1 << idx)
+            self._block_down &= ~(3 << idx)
+        else:
+            self._vwalls &= ~(1 << idx)
+            self._block_right &= ~((1 << idx) | (1 << (idx + BOARD_SIZE)))
+
+    def _can_step(self, square, step):
+        """Return True iff a pawn on the given square may take one step in the given direction (ignoring pawns).
+        """
+        if step == 0:
+            return square >= BOARD_SIZE and not (self._block_down >> (square - BOARD_SIZE)) & 1
+        elif step == 1:
+            return square < N_SQUARES - BOARD_SIZE and not (self._block_down >> square) & 1
+        elif step == 2:
+            return square % BOARD_SIZE > 0 and not (self._block_right >> (square - 1)) & 1
+        else:
+            return square % BOARD_SIZE < BOARD_SIZE - 1 and not (self._block_right >> square) & 1
+
+    def _pawn_destinations(self):
+        """Return the list of squares the current player's pawn may legally move to, including jumps.
+        """
+        own, other = self._pawns[self.current_player], self._pawns[1 - self.current_player]
+        destinations = []
+        for step in range(4):
+            if not self._can_step(own, step):
+                continue
+            target = own + STEP_DELTA[step]
+            if target != other:
+                destinations.append(target)
+            elif self._can_step(other, step):
+                # Straight jump over the other pawn.
+                destinations.append(other + STEP_DELTA[step])
+            else:
+                # The straight jump is blocked. Diagonal jumps are allowed instead.
+                for side in PERPENDICULAR[step]:
+                    if self._can_step(other, side):
+                        destinations.append(other + STEP_DELTA[side])
+        return destinations
+
+    def _expand(self, reached):
+        """Grow the 'reached' mask by one step in every direction that is not blocked by a wall.
+        """
+        block_down, block_right = self._block_down, self._block_right
+        return reached | \
+            ((reached & NOT_LAST_ROW & ~block_down) << BOARD_SIZE) | \
+            ((reached & ~(block_down << BOARD_SIZE)) >> BOARD_SIZE) | \
+            ((reached & NOT_LAST_COL & ~block_right) << 1) | \
+            ((reached & NOT_FIRST_COL & ~(block_right << 1)) >> 1)
+
+    def _has_path(self, player_idx):
+        """Return True iff the given player's pawn can reach its goal row with the walls currently in place.
+        """
+        reached, goal = 1 << self._pawns[player_idx], GOAL_MASKS[player_idx]
+        while not reached & goal:
+            expanded = self._expand(reached)
+            if expanded == reached:
+                return False
+            reached = expanded
+        return True
+
+    def _is_legal_wall(self, kind, idx):
+        if self._wall_counts[self.current_player] == 0:
+            return False
+        if not ((self._open_h if kind == 1 else self._open_v) >> idx) & 1:
+            return False
+        # Same efficiency trick as Quoridor.is_legal: a wall can only cut off a player if it touches another wall.
+        touch_h, touch_v = TOUCHING_MASKS[kind][idx]
+        if not (touch_h & self._hwalls or touch_v & self._vwalls):
+            return True
+        self._place(kind, idx)
+        has_path = self._has_path(0) and self._has_path(1)
+        self._remove(kind, idx)
+        return has_path
+
+    class TempMove:
+        """Class providing do/undo functionality in a with statement. See Quoridor.TempMove.
+        """
+        def __init__(self, game, mv):
+            self.game = game
+            self.mv = mv
+
+        def __enter__(self):
+            if type(self.mv) is int:
+                self.game.exec_move_idx(self.mv, check_legal=False, is_redo=True)
+            else:
+                self.game.exec_move(self.mv, check_legal=False, is_redo=True)
+            return self.game
+
+        def __exit__(self, type, value, traceback):
+            self.game.undo(allow_redo=False)
+
+
+if __name__ == '__main__':
+    # Benchmark: play the same random games through both backends, checking that they agree move for move and timing
+    # the calls that dominate search (all_legal_moves, is_legal, exec_move, undo).
+    import random
+    import time
+    from collections import defaultdict
+    from quoridor import Quoridor
+
+    n_games, max_plies = 20, 80
+    rng = random.Random(1234)
+    timings = {'Quoridor': defaultdict(float), 'BitboardQuoridor': defaultdict(float)}
+    n_plies = 0
+    for _ in range(n_games):
+        games = {'Quoridor': Quoridor(), 'BitboardQuoridor': BitboardQuoridor()}
+        for _ in range(max_plies):
+            legal = {}
+            for name, game in games.items():
+                tstart = time.perf_counter()
+                legal[name] = game.all_legal_moves()
+                timings[name]['all_legal_moves'] += time.perf_counter() - tstart
+            assert set(legal['Quoridor']) == set(legal['BitboardQuoridor']), "Backends disagree on legal moves"
+            mv = rng.choice(sorted(legal['Quoridor']))
+            for name, game in games.items():
+                tstart = time.perf_counter()
+                for other_mv in legal['Quoridor']:
+                    game.is_legal(other_mv)
+                timings[name]['is_legal'] += time.perf_counter() - tstart
+                tstart = time.perf_counter()
+                game.exec_move(mv, check_legal=False)
+                timings[name]['exec_move'] += time.perf_counter() - tstart
+            n_plies += 1
+            if games['Quoridor'].get_winner() is not None:
+                break
+        for name, game in games.items():
+            tstart = time.perf_counter()
+            while len(game.history) > 0:
+                game.undo()
+            timings[name]['undo'] += time.perf_counter() - tstart
+
+    print("Compared {} plies over {} random games".format(n_plies, n_games))
+    for name, times in timings.items():
+        print("{:>18s}: ".format(name) + ", ".join("{} {:.3f}s".format(k, v) for (k, v) in times.items()))
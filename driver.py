@@ -61,6 +61,7 @@ class TkBoard(object):
     save_file = None
     ai_depth = 6
     ai_n_playout = 5000
+    ai_workers = 1
 
     # GAME-INTERACTION VARIABLES
     moveType = "move"
@@ -128,6 +129,7 @@ class TkBoard(object):
         self.ai_running = False
         self.ai_depth = kwargs.get('ai_depth', self.ai_depth)
         self.ai_n_playout = kwargs.get('ai_n_playout', self.ai_n_playout)
+        self.ai_workers = kwargs.get('ai_workers', self.ai_workers)
 
         self.draw_squares()
         self.draw_goals()
@@ -371,7 +373,7 @@ class TkBoard(object):
     def start_ai(self, player_idx):
         def get_and_exec_move(game):
             mv = monte_carlo_tree_search(game, simple_value, simple_policy,
-                                         self.ai_depth, self.ai_n_playout)
+                                         self.ai_depth, self.ai_n_playout, n_workers=self.ai_workers)
             self.ai_running = False
             self.exec_wrapper(mv, is_ai=True)
             print("AI FINISHED")
@@ -548,6 +550,7 @@ if __name__ == "__main__":
     parser.add_argument("--ai", help="number of AI players (Default: 0)", type=int, default=0)
     parser.add_argument("--ai-depth", help="AI players' search depth (Default: 6)", type=int, default=6)  # noqa: E501
     parser.add_argument("--ai-n-playout", help="AI players' number of playouts (Default: 5000)", type=int, default=5000)  # noqa: E501
+    parser.add_argument("--ai-workers", help="AI players' number of playout processes (Default: 1)", type=int, default=1)  # noqa: E501
     parser.add_argument("--save-file", help=".qdr file path of where to save results on quit.")
     parser.add_argument("--load-file", help=".qdr file path of game to load.")
     args = parser.parse_args()
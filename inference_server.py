@@ -0,0 +1,230 @@
+import os
+import selectors
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import multiprocessing as mp
+import numpy as np
+import torch
+from quoridor import Quoridor
+from quornn import encode_state_to_planes, STATE_SHAPE, POLICY_SHAPE
+
+_STATE_SIZE = int(np.prod(STATE_SHAPE))
+_POLICY_SIZE = int(np.prod(POLICY_SHAPE))
+
+
+def _shared_arrays(directory, n_slots):
+    """Map the shared memory of the InferenceServer in 'directory' as numpy arrays: for each slot an encoded state, a
+    policy and a value, followed by two counters of the batches and states evaluated so far.
+    """
+    buf = np.memmap(os.path.join(directory, 'slots'), dtype=np.uint8, mode='r+', shape=(_shared_size(n_slots),))
+    states = np.ndarray((n_slots,) + STATE_SHAPE, dtype=np.float32, buffer=buf)
+    offset = states.nbytes
+    policies = np.ndarray((n_slots,) + POLICY_SHAPE, dtype=np.float32, buffer=buf, offset=offset)
+    offset += policies.nbytes
+    values = np.ndarray((n_slots,), dtype=np.float32, buffer=buf, offset=offset)
+    offset += values.nbytes
+    counters = np.ndarray((2,), dtype=np.int64, buffer=buf, offset=offset)
+    return states, policies, values, counters
+
+
+def _shared_size(n_slots):
+    return n_slots * 4 * (_STATE_SIZE + _POLICY_SIZE + 1) + 2 * 8
+
+
+class InferenceServer(object):
+    """A process that evaluates states for many search workers (processes or threads) with dynamic batching.
+
+    Each client connects over a Unix socket and is given a slot in a block of shared memory (a file mapped into memory
+    by the server and all clients, in /dev/shm where available). To evaluate a state, a client writes the encoded state
+    into its slot and sends one byte; the server collects requests until it has max_batch_size of them or the oldest
+    has waited max_wait_ms, evaluates them all with one call to batch_pol_val_fun, writes each policy and value into
+    its slot, and replies with one byte. Only these bytes go through the socket.
+
+    batch_pol_val_fun maps a (K x 6 x 9 x 9) tensor of states encoded by encode_state_to_planes to a (K x 3 x 9 x 9)
+    tensor of policies and a tensor of K values, as for MonteCarloTreeSearch. It only runs in the server process, so
+    the model is loaded once however many clients there are. n_slots bounds the number of concurrent clients.
+
+    Use as a context manager (or call start() and close()), and pass client() -- an ordinary pol_val_fun, which can be
+    pickled and sent to worker processes -- to the searches.
+    """
+    def __init__(self, batch_pol_val_fun, max_batch_size=32, max_wait_ms=1.0, n_slots=64):
+        self.batch_pol_val_fun = batch_pol_val_fun
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.n_slots = n_slots
+        self._dir = None
+        self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def start(self):
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self._dir = tempfile.mkdtemp(prefix='quoridor-inference-', dir=shm_dir)
+        with open(os.path.join(self._dir, 'slots'), 'wb') as f:
+            f.truncate(_shared_size(self.n_slots))
+        ready = mp.Event()
+        self._process = mp.Process(target=_serve, daemon=True,
+                                   args=(self.batch_pol_val_fun, self._dir, self.n_slots, self.max_batch_size,
+                                         self.max_wait_ms / 1000, ready))
+        self._process.start()
+        if not ready.wait(timeout=60):
+            self.close()
+            raise RuntimeError("Inference server failed to start")
+
+    def close(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def client(self):
+        return InferenceClient(self._dir, self.n_slots)
+
+    def stats(self):
+        """Return the number of batches and of states evaluated so far.
+        """
+        n_batches, n_states = _shared_arrays(self._dir, self.n_slots)[3].tolist()
+        return n_batches, n_states
+
+
+class InferenceClient(object):
+    """A pol_val_fun that evaluates states on an InferenceServer: maps a Quoridor state to a (3 x 9 x 9) policy and a
+    value. Each thread of each process that calls it has its own connection and slot, opened on its first call.
+    """
+    def __init__(self, directory, n_slots):
+        self.directory = directory
+        self.n_slots = n_slots
+        self._values = None
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Connections and memory maps belong to the process (and thread) that opened them.
+        return {'directory': self.directory, 'n_slots': self.n_slots}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'], state['n_slots'])
+
+    def _connection(self):
+        if self._values is None:
+            states, policies, values, _ = _shared_arrays(self.directory, self.n_slots)
+            self._states, self._policies, self._values = torch.from_numpy(states), torch.from_numpy(policies), values
+        if getattr(self._local, 'conn', None) is None:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(os.path.join(self.directory, 'server.sock'))
+            slot = conn.recv(2)
+            if len(slot) < 2:
+                raise RuntimeError("Inference server has no free slots")
+            self._local.conn, self._local.slot = conn, int.from_bytes(slot, 'little')
+        return self._local.conn, self._local.slot
+
+    def __call__(self, state:Quoridor):
+        conn, slot = self._connection()
+        encode_state_to_planes(state, out=self._states[slot])
+        conn.sendall(b'\x01')
+        if conn.recv(1) != b'\x01':
+            raise RuntimeError("Inference server closed the connection")
+        return self._policies[slot].clone(), float(self._values[slot])
+
+
+def _serve(batch_pol_val_fun, directory, n_slots, max_batch_size, max_wait, ready):
+    """Main loop of the InferenceServer process.
+    """
+    states, policies, values, counters = _shared_arrays(directory, n_slots)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(os.path.join(directory, 'server.sock'))
+    listener.listen(n_slots)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    free_slots = list(range(n_slots - 1, -1, -1))
+    pending, deadline = [], None
+    ready.set()
+
+    while True:
+        timeout = None if not pending else max(0.0, deadline - time.monotonic())
+        for key, _ in selector.select(timeout):
+            if key.fileobj is listener:
+                conn, _ = listener.accept()
+                if not free_slots:
+                    conn.close()
+                    continue
+                slot = free_slots.pop()
+                conn.sendall(slot.to_bytes(2, 'little'))
+                selector.register(conn, selectors.EVENT_READ, slot)
+            elif key.fileobj.recv(1):
+                if not pending:
+                    deadline = time.monotonic() + max_wait
+                pending.append((key.fileobj, key.data))
+            else:
+                # The client disconnected. Drop its request, if any, before its slot can go to a new client.
+                pending = [(conn, slot) for conn, slot in pending if conn is not key.fileobj]
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                free_slots.append(key.data)
+
+        if pending and (len(pending) >= max_batch_size or time.monotonic() >= deadline):
+            batch, pending = pending[:max_batch_size], pending[max_batch_size:]
+            # Requests left over from a full batch have waited long enough already.
+            deadline = time.monotonic()
+            slots = [slot for _, slot in batch]
+            with torch.no_grad():
+                batch_policies, batch_values = batch_pol_val_fun(torch.from_numpy(states[slots]))
+            policies[slots] = batch_policies.reshape((len(slots),) + POLICY_SHAPE).numpy()
+            values[slots] = batch_values.reshape(len(slots)).numpy()
+            counters[0] += 1
+            counters[1] += len(slots)
+            for conn, _ in batch:
+                try:
+                    conn.sendall(b'\x01')
+                except OSError:
+                    pass
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ProcessPoolExecutor
+    from mcts import MonteCarloTreeSearch
+
+    # Self-play style throughput: several processes each running searches, evaluating with their own copy of a
+    # convolutional network one state at a time, or sharing one copy on an InferenceServer.
+    torch.manual_seed(0)
+    layers = [torch.nn.Conv2d(6, 128, 3, padding=1), torch.nn.ReLU()]
+    for _ in range(5):
+        layers += [torch.nn.Conv2d(128, 128, 3, padding=1), torch.nn.ReLU()]
+    net = torch.nn.Sequential(*layers, torch.nn.Conv2d(128, 4, 1))
+
+    def batch_pol_val_fun(planes):
+        with torch.no_grad():
+            out = net(planes)
+        policies = torch.softmax(out[:, :3].reshape(len(planes), -1), dim=1).reshape(-1, 3, 9, 9)
+        return policies, torch.tanh(out[:, 3].mean(dim=(1, 2)))
+
+    def local_pol_val_fun(state):
+        policies, values = batch_pol_val_fun(encode_state_to_planes(state, add_batch=True))
+        return policies[0], values[0]
+
+    def run_search(pol_val_fun, n_evals):
+        torch.set_num_threads(1)
+        MonteCarloTreeSearch(Quoridor(), pol_val_fun).search(c_puct=2, n_evals=n_evals)
+
+    n_workers, n_evals = max(2, os.cpu_count() or 1), 200
+    with ProcessPoolExecutor(n_workers) as pool:
+        tstart = time.time()
+        list(pool.map(run_search, [local_pol_val_fun] * n_workers, [n_evals] * n_workers))
+        print("%d workers, local models:     %6.0f simulations per second" %
+              (n_workers, n_workers * n_evals / (time.time() - tstart)))
+        with InferenceServer(batch_pol_val_fun, max_batch_size=n_workers, max_wait_ms=2.0) as server:
+            tstart = time.time()
+            list(pool.map(run_search, [server.client()] * n_workers, [n_evals] * n_workers))
+            n_batches, n_states = server.stats()
+            print("%d workers, inference server: %6.0f simulations per second, average batch size %.1f" %
+                  (n_workers, n_workers * n_evals / (time.time() - tstart), n_states / n_batches))
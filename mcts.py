@@ -1,113 +1,469 @@
 from __future__ import annotations
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
+import numpy as np
 import torch
-from quoridor import Quoridor, IllegalMove
-from quornn import encode_actions_to_planes, action_to_coordinate, sample_action
+from quoridor import Quoridor, IllegalMove, ACTION_TARGETS, PERSPECTIVE_INDEX
+from quornn import encode_state_to_planes, sample_action_index, PlaneTracker, STATE_SHAPE, POLICY_SHAPE
+
+_PERSPECTIVE_INDEX = np.array(PERSPECTIVE_INDEX, dtype=np.int64)
+
+# Number of locks that the nodes (and, separately, the hash keys) of a tree are spread over in threaded searches.
+N_LOCK_STRIPES = 64
+
+# Values of NodeStore.legal. Pawn moves are known to be legal when a node is created, but walls are only checked the
+# first time the search selects them (see TreeNode.select), so most walls are never checked at all.
+UNCHECKED, LEGAL, ILLEGAL = 0, 1, -1
+
+
+class NodeStore(object):
+    """Struct-of-arrays storage for the nodes of a search tree, addressed by integer node ids.
+
+    Each node owns a contiguous block of 'edges', one per action that was legal (up to the lazy wall check) when the
+    node was created, sorted by their index into the policy planes of the player to move. Edge arrays hold the action
+    (in board coordinates), its prior, visit count, value sum, legality and the id of the child node it leads to (-1
+    if none yet). Node arrays hold the first edge and number of edges, the player to move, the value from the
+    evaluation (NaN until evaluated), the number of references to the node (edges leading to it, plus one if it is
+    the root of a search) and the generation stamp of the last garbage collection that reached it. All arrays are
+    preallocated and doubled when full; the blocks of freed nodes are reused by later nodes with the same number of
+    edges.
+
+    Allocation is thread-safe, but growing the arrays is not safe while other threads access them, so threaded
+    searches only grow them through a _GrowthGuard.
+    """
+    # Upper bound on the number of edges of a node: 5 pawn moves (4 steps, or 3 steps and 2 diagonal jumps) and 128
+    # walls
+    MAX_EDGES = 5 + 2 * 8 * 8
+
+    def __init__(self, node_capacity=1024, edge_capacity=1024*64):
+        self.first_edge = np.zeros(node_capacity, dtype=np.int64)
+        self.n_edges = np.zeros(node_capacity, dtype=np.int32)
+        self.player = np.zeros(node_capacity, dtype=np.int8)
+        self.value = np.zeros(node_capacity, dtype=np.float32)
+        self.refs = np.zeros(node_capacity, dtype=np.int32)
+        self.stamp = np.zeros(node_capacity, dtype=np.int32)
+        self.keys = [None] * node_capacity
+        self.action = np.zeros(edge_capacity, dtype=np.int16)
+        self.prior = np.zeros(edge_capacity, dtype=np.float32)
+        self.count = np.zeros(edge_capacity, dtype=np.int32)
+        self.value_sum = np.zeros(edge_capacity, dtype=np.float32)
+        self.child = np.zeros(edge_capacity, dtype=np.int32)
+        self.legal = np.zeros(edge_capacity, dtype=np.int8)
+        self._n_nodes, self._n_edges = 0, 0
+        self._free_nodes, self._free_blocks = [], {}
+        self.size = 0
+        self.generation = 0
+        self._alloc_lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        node_arrays = (self.first_edge, self.n_edges, self.player, self.value, self.refs, self.stamp)
+        edge_arrays = (self.action, self.prior, self.count, self.value_sum, self.child, self.legal)
+        return sum(a.nbytes for a in node_arrays + edge_arrays) + 8 * len(self.keys)
+
+    def reserve(self, n_nodes, n_edges):
+        """Grow the arrays, if needed, so that n_nodes more nodes with a total of n_edges edges fit without growing.
+        """
+        if self._n_nodes + n_nodes > len(self.first_edge):
+            capacity = max(2 * len(self.first_edge), self._n_nodes + n_nodes)
+            for name in ('first_edge', 'n_edges', 'player', 'value', 'refs', 'stamp'):
+                setattr(self, name, np.resize(getattr(self, name), capacity))
+            self.keys.extend([None] * (capacity - len(self.keys)))
+        if self._n_edges + n_edges > len(self.action):
+            capacity = max(2 * len(self.action), self._n_edges + n_edges)
+            for name in ('action', 'prior', 'count', 'value_sum', 'child', 'legal'):
+                setattr(self, name, np.resize(getattr(self, name), capacity))
+
+    def _alloc(self, n):
+        """Return the id of a new node and the first of its n new edges.
+        """
+        with self._alloc_lock:
+            blocks = self._free_blocks.get(n)
+            if blocks:
+                start = blocks.pop()
+            else:
+                self.reserve(0, n)
+                start = self._n_edges
+                self._n_edges += n
+            if self._free_nodes:
+                node = self._free_nodes.pop()
+            else:
+                self.reserve(1, 0)
+                node = self._n_nodes
+                self._n_nodes += 1
+            self.size += 1
+        return node, start
+
+    def add(self, game_state:Quoridor) -> int:
+        """Allocate a node for game_state and return its id. Its priors and value are set later by set_evaluation.
+        """
+        player = game_state.current_player
+        actions = np.array(game_state.legal_action_indices(partial_check=True), dtype=np.int16)
+        # Sorting by policy index makes ties between edges resolve the same way as an argmax over the policy planes.
+        actions = actions[np.argsort(_PERSPECTIVE_INDEX[player, actions])]
+        n = len(actions)
+        node, start = self._alloc(n)
+        end = start + n
+        self.action[start:end] = actions
+        self.prior[start:end] = 0
+        self.count[start:end] = 0
+        self.value_sum[start:end] = 0
+        self.child[start:end] = -1
+        self.legal[start:end] = np.where(actions < 81, LEGAL, UNCHECKED)
+        self.first_edge[node], self.n_edges[node] = start, n
+        self.player[node], self.value[node] = player, np.nan
+        self.refs[node], self.stamp[node] = 0, self.generation
+        self.keys[node] = game_state.hash_key()
+        return node
+
+    def set_evaluation(self, node:int, policy, value):
+        """Set the priors of a node's edges from a (3 x 9 x 9) policy, oriented to the player to move, and its value.
+        """
+        start = self.first_edge[node]
+        end = start + self.n_edges[node]
+        if isinstance(policy, torch.Tensor):
+            policy = policy.detach().numpy()
+        policy = np.asarray(policy, dtype=np.float32).reshape(-1)
+        self.prior[start:end] = policy[_PERSPECTIVE_INDEX[self.player[node], self.action[start:end]]]
+        self.value[node] = float(value)
+
+    def free(self, nodes:np.ndarray):
+        """Release the given nodes and their edges for reuse. Edges of other nodes pointing to them are not updated.
+        """
+        with self._alloc_lock:
+            for node, start, n in zip(nodes.tolist(), self.first_edge[nodes].tolist(), self.n_edges[nodes].tolist()):
+                self._free_blocks.setdefault(n, []).append(start)
+                self._free_nodes.append(node)
+                self.keys[node] = None
+            self.size -= len(nodes)
+
+    def children(self, nodes:np.ndarray) -> np.ndarray:
+        """Return the ids of the children of all the given nodes (with repeats if several of them share a child).
+        """
+        counts = self.n_edges[nodes]
+        offsets = np.repeat(self.first_edge[nodes] - np.cumsum(counts) + counts, counts)
+        child = self.child[offsets + np.arange(len(offsets))]
+        return child[child >= 0]
+
+    def edges(self, node:int) -> slice:
+        start = int(self.first_edge[node])
+        return slice(start, start + int(self.n_edges[node]))
+
+
+class _GrowthGuard(object):
+    """Lets the threads of a threaded search share a NodeStore whose arrays may need to grow.
+
+    Each simulation runs inside 'with guard:', which first makes sure that the store has room for one more node with
+    MAX_EDGES edges for every simulation running, itself included. When it does not, the thread waits until no other
+    simulation is running and then grows the arrays, so that they are never reallocated while another thread uses them.
+    """
+    def __init__(self, store:NodeStore, n_threads:int):
+        self._store = store
+        self._n_threads = n_threads
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def _has_room(self, n_sims):
+        store = self._store
+        return (store._n_nodes + n_sims <= len(store.first_edge) and
+                store._n_edges + n_sims * NodeStore.MAX_EDGES <= len(store.action))
+
+    def __enter__(self):
+        with self._cond:
+            while not self._has_room(self._running + 1):
+                if self._running == 0:
+                    # Arrays grow by doubling, so this happens a logarithmic number of times.
+                    self._store.reserve(self._n_threads, self._n_threads * NodeStore.MAX_EDGES)
+                else:
+                    self._cond.wait()
+            self._running += 1
+
+    def __exit__(self, type, value, traceback):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
 
 
 class TreeNode(object):
-    def __init__(self, game_state:Quoridor, policy_output, value_output):
-        # _counts is the number of times we've taken some action *from this state*. Initialized to all zeros. Stored
-        # as a torch tensor over all possible actions, to be later masked with the set of legal actions
-        self._counts = torch.zeros(3, 9, 9)
-        self._total_reward = torch.zeros(3, 9, 9)
-        self._policy = policy_output
-        self._value = value_output
-        self._legal_mask = encode_actions_to_planes(game_state.all_legal_moves(), game_state.current_player)
-        self._player = game_state.current_player
-        self._key = game_state.hash_key()
-        self._children = {}
-        self.__flagged = False
+    """A view of one node of a NodeStore. Views are cheap to create and compare equal iff they refer to the same node.
+
+    Edges are addressed by their (global) index in the store, as returned by select().
+    """
+    __slots__ = ('_store', '_id')
+
+    def __init__(self, store:NodeStore, node_id:int):
+        self._store = store
+        self._id = node_id
 
     def __str__(self):
-        return "TreeNode[{}] --> [{}]".format(self._key, ",".join(self._children.keys()))
+        store, edges = self._store, self._store.edges(self._id)
+        children = ",".join(str(ACTION_TARGETS[a]) for a in store.action[edges][store.child[edges] >= 0])
+        return "TreeNode[{}] --> [{}]".format(self._key, children)
 
     def __repr__(self):
         return str(self)
 
+    def __eq__(self, other):
+        return isinstance(other, TreeNode) and self._store is other._store and self._id == other._id
+
+    def __hash__(self):
+        return hash(self._id)
+
+    @property
+    def _player(self):
+        return int(self._store.player[self._id])
+
     @property
-    def _avg_reward(self):
-        return self._total_reward / (self._counts + 1e-6)
+    def _key(self):
+        return self._store.keys[self._id]
 
-    def add_child(self, action:str, node:TreeNode):
-        self._children[action] = node
+    @property
+    def _value(self):
+        return float(self._store.value[self._id])
 
-    def upper_conf(self, c_puct) -> torch.Tensor:
-        u = self._avg_reward + c_puct * self._policy * torch.sqrt(self._counts.sum()) / (1. + self._counts)
-        u.masked_fill_(self._legal_mask == 0, -float('inf'))
+    def children(self):
+        """Return the array of ids of the child nodes that have been reached from this node.
+        """
+        child = self._store.child[self._store.edges(self._id)]
+        return child[child >= 0]
+
+    def upper_conf(self, c_puct) -> np.ndarray:
+        """Return the PUCT upper confidence bound of each of this node's edges, -inf for known illegal actions.
+        """
+        store, edges = self._store, self._store.edges(self._id)
+        counts = store.count[edges]
+        u = store.value_sum[edges] / (counts + 1e-6)
+        u += c_puct * store.prior[edges] * np.sqrt(counts.sum()) / (1. + counts)
+        u[store.legal[edges] == ILLEGAL] = -np.inf
         return u
 
+    def select(self, game_state:Quoridor, c_puct) -> int:
+        """Return the edge with the highest upper confidence bound whose action is legal in game_state (the state of
+        this node). Walls are checked against game_state the first time they are selected.
+        """
+        store, start = self._store, int(self._store.first_edge[self._id])
+        while True:
+            edge = start + int(np.argmax(self.upper_conf(c_puct)))
+            if store.legal[edge] == LEGAL:
+                return edge
+            elif game_state.is_legal_idx(int(store.action[edge])):
+                store.legal[edge] = LEGAL
+                return edge
+            store.legal[edge] = ILLEGAL
+
+    def action(self, edge:int) -> int:
+        return int(self._store.action[edge])
+
+    def add_child(self, edge:int, node:TreeNode):
+        if self.set_child(edge, node):
+            self._store.refs[node._id] += 1
+
+    def set_child(self, edge:int, node:TreeNode) -> bool:
+        """Make 'edge' lead to 'node' unless it already leads to a node, and return whether it did. Unlike add_child,
+        this does not count the new reference to 'node'.
+        """
+        if self._store.child[edge] >= 0:
+            return False
+        self._store.child[edge] = node._id
+        return True
+
+    def add_virtual_loss(self, edge:int, loss:float):
+        """Count a provisional loss of 'loss' for 'edge', so that other simulations of the same batch that pass
+        through this node are steered towards other actions until the real result is backed up.
+        """
+        self._store.value_sum[edge] -= loss
+        self._store.count[edge] += 1
+
+    def remove_virtual_loss(self, edge:int, loss:float):
+        self._store.value_sum[edge] += loss
+        self._store.count[edge] -= 1
+
+    def backup(self, edge:int, value):
+        self._store.value_sum[edge] += float(value)
+        self._store.count[edge] += 1
+
     def policy_target(self) -> torch.Tensor:
-        return self._counts / self._counts.sum()
-
-    def backup(self, action:str, value):
-        action_ijk = action_to_coordinate(action, self._player)
-        self._total_reward[action_ijk] += value.item()
-        self._counts[action_ijk] += 1
-
-    def delete_unflagged_subtree(self):
-        deleted_nodes = {self} if not self.__flagged else set()
-        to_delete = list(self._children.items())
-        for mv, node in to_delete:
-            if not node.__flagged:
-                deleted_nodes |= node.delete_unflagged_subtree()
-                del self._children[mv]
-        return deleted_nodes
+        """Return the visit counts of this node's actions, normalized and scattered into (3 x 9 x 9) policy planes.
+        """
+        store, edges = self._store, self._store.edges(self._id)
+        counts = store.count[edges]
+        target = torch.zeros(POLICY_SHAPE)
+        indices = _PERSPECTIVE_INDEX[self._player, store.action[edges]]
+        target.view(-1)[torch.from_numpy(indices)] = torch.from_numpy(counts / counts.sum()).float()
+        return target
 
-    def subtree_flagged(self):
-        return TreeNode.SubtreeFlagger(self)
 
-    class SubtreeFlagger:
-        def __init__(self, node):
-            self.node = node
+class EvaluationCache(object):
+    """A pol_val_fun that wraps another one with a cache of its results, keyed by the states' hash_key().
 
-        def __enter__(self):
-            def recursively_flag(node):
-                node.__flagged = True
-                for mv, chld in node._children.items():
-                    recursively_flag(chld)
-            recursively_flag(self.node)
+    The hash key covers the player to move, and policies are cached as returned, i.e. oriented to the player to move,
+    so a cached policy is only ever served to states with the same player to move and the same orientation. The least
+    recently used entries are evicted once there are more than max_entries of them, or (if max_bytes is given) once
+    their policies and values take more than max_bytes.
+
+    If 'shared' is given, it is a second level of cache shared between processes, such as a dict made by a
+    multiprocessing.Manager(): local misses are looked up in it, and new evaluations are added to it until it holds
+    max_entries of them (it is never evicted from). When pickled, e.g. to be sent to a worker process, the local entries
+    are left out. It may be called from several threads at once.
+    """
+    def __init__(self, pol_val_fun, max_entries=100000, max_bytes=None, shared=None):
+        self.pol_val_fun = pol_val_fun
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits, self.shared_hits, self.misses = 0, 0, 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_entries'], state['nbytes'] = OrderedDict(), 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        n_calls = self.hits + self.shared_hits + self.misses
+        return (self.hits + self.shared_hits) / n_calls if n_calls > 0 else 0.0
+
+    def __call__(self, state:Quoridor):
+        key = state.hash_key()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            entry = self.shared.get(key) if self.shared is not None else None
+            if entry is not None:
+                self._add(key, entry, shared_hit=True)
+            else:
+                policy, value = self.pol_val_fun(state)
+                if isinstance(policy, torch.Tensor):
+                    policy = policy.detach().numpy()
+                entry = (np.array(policy, dtype=np.float32), float(value))
+                if self.shared is not None and len(self.shared) < self.max_entries:
+                    self.shared[key] = entry
+                self._add(key, entry, shared_hit=False)
+        # Return a copy, so that the caller is free to modify it.
+        return torch.from_numpy(entry[0].copy()), entry[1]
+
+    def _add(self, key, entry, shared_hit):
+        with self._lock:
+            if shared_hit:
+                self.shared_hits += 1
+            else:
+                self.misses += 1
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self.nbytes += entry[0].nbytes + 8
+            while len(self._entries) > self.max_entries or self.max_bytes is not None and self.nbytes > self.max_bytes:
+                _, (policy, _) = self._entries.popitem(last=False)
+                self.nbytes -= policy.nbytes + 8
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
 
-        def __exit__(self, type, value, traceback):
-            def recursively_unflag(node):
-                node.__flagged = False
-                for mv, chld in node._children.items():
-                    recursively_unflag(chld)
-            recursively_unflag(self.node)
 
 class MonteCarloTreeSearch(object):
-    def __init__(self, init_state:Quoridor, pol_val_fun):
+    # step_and_prune only frees nodes whose last reference it drops, so nodes that reference each other in a cycle (the
+    # same position reached again by moving pawns back and forth) survive it. Every gc_interval moves it also runs
+    # collect_garbage, which reclaims those too.
+    gc_interval = 8
+
+    def __init__(self, init_state:Quoridor, pol_val_fun, batch_pol_val_fun=None):
+        """pol_val_fun maps a Quoridor state to a (3 x 9 x 9) policy and a value. batch_pol_val_fun, which is required
+        for batched searches (see search), maps a (K x 6 x 9 x 9) tensor of states encoded by encode_state_to_planes
+        to a (K x 3 x 9 x 9) tensor of policies and a tensor of K values. Attaching a quornn.PlaneTracker to init_state
+        makes encoding each state a single copy, for this search and for any copies of the state made by threads or
+        worker processes.
+        """
         self.pol_val_fun = pol_val_fun
-        self._root = TreeNode(init_state, *pol_val_fun(init_state))
-        self._node_lookup = {init_state.hash_key(): self._root}
+        self.batch_pol_val_fun = batch_pol_val_fun
+        self._store = NodeStore()
+        # Maps hash keys to node ids in _store.
+        self._node_lookup = {}
+        self._root = self._add_node(init_state, *pol_val_fun(init_state))
+        self._store.refs[self._root._id] += 1
         self._state = init_state
+        self._n_moves = 0
+        self._pruner = None
 
     @property
     def player(self):
         return self._root._player
 
-    def search(self, c_puct=0.9, n_evals=1000, verbose=False) -> torch.Tensor:
+    def _add_node(self, game:Quoridor, policy=None, value=None) -> TreeNode:
+        node = TreeNode(self._store, self._store.add(game))
+        if policy is not None:
+            self._store.set_evaluation(node._id, policy, value)
+        self._node_lookup[node._key] = node._id
+        return node
+
+    def _lookup(self, key) -> TreeNode:
+        return TreeNode(self._store, self._node_lookup[key])
+
+    def search(self, c_puct=0.9, n_evals=1000, verbose=False, batch_size=1, virtual_loss=1.0, n_threads=1, n_workers=1,
+               seed=None) -> torch.Tensor:
+        """Run n_evals simulations from the root. If batch_size > 1, simulations are run in batches of that many (see
+        _batched_search), with all of a batch's new leaves evaluated by a single call to batch_pol_val_fun. If
+        n_threads > 1, that many threads run simulations on the shared tree at once (see _threaded_search), which
+        pays off when pol_val_fun releases the GIL, as PyTorch does during inference. If n_workers > 1, that many
+        processes each build an independent tree instead (see _root_parallel_search), seeded from 'seed'.
+        """
+        self.wait_for_prune()
         the_key = self._state.hash_key()
         if the_key != self._root._key:
             raise RuntimeError("Tree search precondition failed... the root should never deviate from the state object")
+        if batch_size > 1 and self.batch_pol_val_fun is None:
+            raise ValueError("Batched search requires a batch_pol_val_fun")
+        if sum(n > 1 for n in (batch_size, n_threads, n_workers)) > 1:
+            raise ValueError("Only one of batch_size, n_threads and n_workers may be greater than 1")
 
-        for isearch in range(n_evals):
+        if n_threads > 1:
+            self._threaded_search(c_puct, n_evals, n_threads, virtual_loss)
+            n_evals = 0
+        elif n_workers > 1:
+            self._root_parallel_search(c_puct, n_evals, n_workers, seed)
+            n_evals = 0
+        for isearch in range(0, n_evals, batch_size):
             if verbose:
                 print("MCTS.search run", isearch+1, "of", n_evals)
                 print("Root is", str(self._root), "in tree of size", len(self._node_lookup))
-            self._single_search(self._state, c_puct, verbose=verbose)
+            if batch_size > 1:
+                self._batched_search(self._state, c_puct, min(batch_size, n_evals - isearch), virtual_loss)
+            else:
+                self._single_search(self._state, c_puct, verbose=verbose)
             if the_key != self._state.hash_key():
                 raise RuntimeError("Consistency failure... calling _single_search modified the state!")
 
         # Return estimated policy
-        return self._node_lookup[self._state.hash_key()].policy_target()
+        return self._lookup(self._state.hash_key()).policy_target()
 
-    def _single_search(self, game:Quoridor, c_puct, verbose=False) -> float:
+    def _single_search(self, game:Quoridor, c_puct, verbose=False, path_keys=None) -> float:
         """Recursively run a single MCTS thread out from the given state using exploration parameter 'c_puct'.
+
+        path_keys is the set of the keys of the states this simulation has already passed through.
         """
-        node = self._node_lookup[game.hash_key()]
-        action = sample_action(node.upper_conf(c_puct), node._player, temperature=0.0)
+        node = self._lookup(game.hash_key())
+        path_keys = path_keys if path_keys is not None else set()
+        path_keys.add(node._key)
+        edge = node.select(game, c_puct)
+        action = node.action(edge)
         if verbose:
-            print("\tsingle_search starting @", node, "\n\t\ttaking", action, end="")
+            print("\tsingle_search starting @", node, "\n\t\ttaking", ACTION_TARGETS[action], end="")
         with game.temp_move(action):
             winner = game.get_winner()
             if winner is not None:
@@ -118,42 +474,303 @@ class MonteCarloTreeSearch(object):
             elif game.hash_key() not in self._node_lookup:
                 # Case 2: 'action' resulted in a state we've never seen before. Create a new node and return
                 pol, val = self.pol_val_fun(game)
-                new_node = TreeNode(game, pol, val)
-                self._node_lookup[game.hash_key()] = new_node
-                node.add_child(action, new_node)
+                new_node = self._add_node(game, pol, val)
+                node.add_child(edge, new_node)
                 if verbose:
                     print("--> leaf <{}> with value".format(str(new_node)), val)
                 # "val" is from the perspective of "new_node" but we're evaluating "node". Flip sign for minmax.
-                backup_val = -val
+                backup_val = -float(val)
+            elif game.hash_key() in path_keys:
+                # Case 3: the simulation repeated a position (pawns moved back and forth). Count it as a draw rather
+                # than recursing into the same cycle with the same statistics forever.
+                if verbose:
+                    print("--> repetition")
+                node.add_child(edge, self._lookup(game.hash_key()))
+                backup_val = 0
             else:
-                # Case 3: we've seen this state before. But it's possible we're reaching it from a different history.
+                # Case 4: we've seen this state before. But it's possible we're reaching it from a different history.
                 # Ensure the parent/child relationship exists then recurse, flipping the sign of the child node's value.
+                child = self._lookup(game.hash_key())
                 if verbose:
-                    print("--> recursing to node", self._node_lookup[game.hash_key()])
-                node.add_child(action, self._node_lookup[game.hash_key()])
-                backup_val = -self._single_search(game, c_puct, verbose=verbose)
+                    print("--> recursing to node", child)
+                node.add_child(edge, child)
+                backup_val = -self._single_search(game, c_puct, verbose=verbose, path_keys=path_keys)
 
         # Apply backup
-        node.backup(action, backup_val)
+        path_keys.discard(node._key)
+        node.backup(edge, backup_val)
         return backup_val
 
-    def step_and_prune(self, action, verbose=False):
-        """Advance the tree by one move, fully discarding all un-taken branches of the tree
+    def _batched_search(self, game:Quoridor, c_puct, batch_size, virtual_loss):
+        """Run 'batch_size' simulations out from the given state, like _single_search, but collect the new leaves they
+        reach and evaluate them all with one call to batch_pol_val_fun before backing up any results.
+
+        Each simulation adds a virtual loss to the actions along its path so that the following ones pick different
+        paths. Simulations that reach a leaf already collected by this batch share its evaluation.
+        """
+        paths, new_nodes, new_keys = [], [], {}
+        planes = torch.zeros((batch_size,) + STATE_SHAPE)
+        for _ in range(batch_size):
+            node, path = self._lookup(game.hash_key()), []
+            while True:
+                edge = node.select(game, c_puct)
+                node.add_virtual_loss(edge, virtual_loss)
+                path.append((node, edge))
+                game.exec_move_idx(node.action(edge), check_legal=False, is_redo=True)
+                winner, key = game.get_winner(), game.hash_key()
+                if winner is not None:
+                    # The path ends in a win or loss, from the perspective of whoever played the last move.
+                    leaf = (+1 if winner == node._player else -1, None)
+                    break
+                elif key in new_keys:
+                    node.add_child(edge, new_nodes[new_keys[key]])
+                    leaf = (None, new_keys[key])
+                    break
+                elif key not in self._node_lookup:
+                    # New leaf. Its policy and value are filled in once the whole batch has been evaluated.
+                    new_node = self._add_node(game)
+                    node.add_child(edge, new_node)
+                    encode_state_to_planes(game, out=planes[len(new_nodes)])
+                    new_keys[key] = len(new_nodes)
+                    new_nodes.append(new_node)
+                    leaf = (None, new_keys[key])
+                    break
+                else:
+                    child = self._lookup(key)
+                    node.add_child(edge, child)
+                    node = child
+            for _ in path:
+                game.undo(allow_redo=False)
+            paths.append((path, leaf))
+
+        if len(new_nodes) > 0:
+            policies, values = self.batch_pol_val_fun(planes[:len(new_nodes)])
+            for i, new_node in enumerate(new_nodes):
+                self._store.set_evaluation(new_node._id, policies[i], values[i])
+
+        for path, (backup_val, leaf_idx) in paths:
+            if backup_val is None:
+                # The leaf's value is from its own perspective, but we're evaluating its parent. Flip sign for minmax.
+                backup_val = -new_nodes[leaf_idx]._value
+            for node, edge in reversed(path):
+                node.remove_virtual_loss(edge, virtual_loss)
+                node.backup(edge, backup_val)
+                backup_val = -backup_val
+
+    def _threaded_search(self, c_puct, n_evals, n_threads, virtual_loss):
+        """Split n_evals simulations over n_threads threads that share the tree, each with its own copy of the game.
+
+        Threads steer each other away from the paths they are on with virtual losses, as in _batched_search. Each node
+        is guarded by one of N_LOCK_STRIPES locks while an action is selected from it or backed up through it, and each
+        hash key by one of another N_LOCK_STRIPES locks while its node is created, so that a state reached by two
+        threads is only evaluated once. A thread never holds two of these locks at once. The store's arrays only grow
+        between simulations, through a _GrowthGuard.
         """
+        guard = _GrowthGuard(self._store, n_threads)
+        node_locks = [threading.Lock() for _ in range(N_LOCK_STRIPES)]
+        key_locks = [threading.Lock() for _ in range(N_LOCK_STRIPES)]
+        games = [self._copy_state() for _ in range(n_threads)]
+        with ThreadPoolExecutor(n_threads) as pool:
+            futures = [pool.submit(self._search_thread, games[i], c_puct,
+                                   n_evals // n_threads + (i < n_evals % n_threads), virtual_loss, node_locks,
+                                   key_locks, guard) for i in range(n_threads)]
+            for future in futures:
+                future.result()
+
+    def _copy_state(self) -> Quoridor:
+        """Return a copy of the root state, with its own PlaneTracker if the root state has one.
+        """
+        game = Quoridor.from_snapshot(self._state.snapshot(), self._state.strict_hash)
+        if self._state.plane_tracker is not None:
+            PlaneTracker(game)
+        return game
+
+    def _search_thread(self, game:Quoridor, c_puct, n_evals, virtual_loss, node_locks, key_locks, guard):
+        for _ in range(n_evals):
+            with guard:
+                self._thread_simulation(game, c_puct, virtual_loss, node_locks, key_locks)
+
+    def _thread_simulation(self, game:Quoridor, c_puct, virtual_loss, node_locks, key_locks):
+        """Run one simulation of _threaded_search, from the root to a new node or the end of the game and back.
+        """
+        node, path = self._root, []
+        while True:
+            with node_locks[node._id % N_LOCK_STRIPES]:
+                edge = node.select(game, c_puct)
+                node.add_virtual_loss(edge, virtual_loss)
+            path.append((node, edge))
+            game.exec_move_idx(node.action(edge), check_legal=False, is_redo=True)
+            winner, key = game.get_winner(), game.hash_key()
+            if winner is not None:
+                # The path ends in a win or loss, from the perspective of whoever played the last move.
+                backup_val = +1 if winner == node._player else -1
+                break
+            child_id, created = self._node_lookup.get(key), False
+            if child_id is None:
+                with key_locks[hash(key) % N_LOCK_STRIPES]:
+                    child_id = self._node_lookup.get(key)
+                    if child_id is None:
+                        # Only publish the node in _node_lookup once it has been evaluated.
+                        child = TreeNode(self._store, self._store.add(game))
+                        self._store.set_evaluation(child._id, *self.pol_val_fun(game))
+                        self._node_lookup[key] = child_id = child._id
+                        created = True
+            child = TreeNode(self._store, child_id)
+            with node_locks[node._id % N_LOCK_STRIPES]:
+                linked = node.set_child(edge, child)
+            if linked:
+                # Other parents of the child may be linking to it at the same time.
+                with node_locks[child_id % N_LOCK_STRIPES]:
+                    self._store.refs[child_id] += 1
+            if created:
+                # The leaf's value is from its own perspective, but we're evaluating its parent. Flip sign.
+                backup_val = -child._value
+                break
+            node = child
+        for _ in path:
+            game.undo(allow_redo=False)
+        for node, edge in reversed(path):
+            with node_locks[node._id % N_LOCK_STRIPES]:
+                node.remove_virtual_loss(edge, virtual_loss)
+                node.backup(edge, backup_val)
+            backup_val = -backup_val
+
+    def _root_parallel_search(self, c_puct, n_evals, n_workers, seed):
+        """Split n_evals simulations over a pool of n_workers processes that each search an independent tree from the
+        root, and add up the visit counts and value sums of their roots' edges into this tree's root.
+
+        Workers seed the torch, numpy and random generators from 'seed', so their trees only differ as far as
+        pol_val_fun is random (e.g. a rollout evaluator). pol_val_fun must be picklable, i.e. a module-level function
+        rather than a lambda. Only the root's statistics are merged; the rest of this tree is left as it was, so the
+        children behind the merged edges are created by step_and_prune when it needs them.
+        """
+        seeds = np.random.SeedSequence(seed).spawn(n_workers)
+        snapshot = self._state.snapshot()
+        counts = [n_evals // n_workers + (1 if i < n_evals % n_workers else 0) for i in range(n_workers)]
+        store, edges = self._store, self._store.edges(self._root._id)
+        with ProcessPoolExecutor(n_workers) as pool:
+            futures = [pool.submit(_search_from_snapshot, snapshot, self._state.strict_hash,
+                                   self._state.plane_tracker is not None, self.pol_val_fun, c_puct, n, s)
+                       for (n, s) in zip(counts, seeds)]
+            for future in futures:
+                # Both trees' roots are the same state, so their edges are the same actions in the same order.
+                count, value_sum, legal = future.result()
+                store.count[edges] += count
+                store.value_sum[edges] += value_sum
+                store.legal[edges] = np.where(legal != UNCHECKED, legal, store.legal[edges])
+
+    def step_and_prune(self, action:int, verbose=False, background=False):
+        """Advance the tree by one move (given as an action index), discarding all un-taken branches of the tree.
+
+        Only the discarded nodes are visited, so the cost is proportional to the discarded part of the tree rather than
+        the whole tree. If background is True, they are freed by a thread that runs until the next call to search,
+        step_and_prune or wait_for_prune.
+        """
+        self.wait_for_prune()
         if self._state.hash_key() != self._root._key:
             raise RuntimeError("Tree consistency failed... the root should never deviate from the state object")
-        self._state.exec_move(action)
+        self._state.exec_move_idx(action)
 
-        new_root = self._node_lookup[self._state.hash_key()]
-        with new_root.subtree_flagged():
-            deleted_nodes = self._root.delete_unflagged_subtree()
-            for node in deleted_nodes:
-                del self._node_lookup[node._key]
-        if verbose:
-            import pprint
-            print("-- PRUNING --")
-            pprint.pprint(deleted_nodes)
+        if self._state.hash_key() not in self._node_lookup:
+            # The action was never searched from this tree, e.g. after a root-parallel search (whose workers' subtrees
+            # are not merged) or when the opponent plays an unexplored move. Start over from a new root.
+            self._add_node(self._state, *self.pol_val_fun(self._state))
+        old_root, new_root = self._root, self._lookup(self._state.hash_key())
+        self._store.refs[new_root._id] += 1
         self._root = new_root
+        self._n_moves += 1
+        collect = self._n_moves % self.gc_interval == 0
+
+        def prune():
+            deleted_nodes = self._release(old_root._id, verbose)
+            if collect:
+                deleted_nodes += self.collect_garbage(verbose)
+            if verbose:
+                import pprint
+                print("-- PRUNING --")
+                pprint.pprint(deleted_nodes)
+
+        if background:
+            self._pruner = threading.Thread(target=prune, daemon=True)
+            self._pruner.start()
+        else:
+            prune()
+
+    def wait_for_prune(self):
+        """Block until a background prune started by step_and_prune (if any) has finished.
+        """
+        if self._pruner is not None:
+            self._pruner.join()
+            self._pruner = None
+
+    def _release(self, node_id:int, verbose=False) -> list:
+        """Drop one reference to the given node. Free it if that was the last one, and drop the references held by the
+        edges of each freed node in turn. Return the list of freed nodes if verbose, else an empty list.
+
+        Nodes are released in waves: each wave frees the nodes whose last reference was dropped by the previous wave,
+        and collects their children with array operations.
+        """
+        store, deleted_nodes = self._store, []
+        released = np.array([node_id])
+        while len(released) > 0:
+            np.subtract.at(store.refs, released, 1)
+            freed = np.unique(released[store.refs[released] == 0])
+            if len(freed) == 0:
+                break
+            released = store.children(freed)
+            if verbose:
+                deleted_nodes.extend(str(TreeNode(store, node)) for node in freed)
+            for node in freed.tolist():
+                del self._node_lookup[store.keys[node]]
+            store.free(freed)
+        return deleted_nodes
+
+    def collect_garbage(self, verbose=False) -> list:
+        """Free every node that is not reachable from the root, including nodes in unreachable cycles, which
+        step_and_prune alone does not free. Return the list of freed nodes if verbose, else an empty list.
+
+        Reachable nodes are stamped with a new generation number, so nothing needs to be unmarked afterwards.
+        """
+        store = self._store
+        store.generation += 1
+        generation, stack = store.generation, [self._root._id]
+        store.stamp[self._root._id] = generation
+        while stack:
+            for child in TreeNode(store, stack.pop()).children().tolist():
+                if store.stamp[child] != generation:
+                    store.stamp[child] = generation
+                    stack.append(child)
+
+        garbage = [node for node in self._node_lookup.values() if store.stamp[node] != generation]
+        deleted_nodes = [str(TreeNode(store, node)) for node in garbage] if verbose else []
+        for node in garbage:
+            # References from garbage to reachable nodes go away with the garbage.
+            for child in TreeNode(store, node).children().tolist():
+                if store.stamp[child] == generation:
+                    store.refs[child] -= 1
+        for node in garbage:
+            del self._node_lookup[store.keys[node]]
+        store.free(np.array(garbage, dtype=np.int64))
+        return deleted_nodes
+
+
+def _search_from_snapshot(snapshot, strict_hash, track_planes, pol_val_fun, c_puct, n_evals, seed_sequence):
+    """Task run by the workers of MonteCarloTreeSearch._root_parallel_search: search a new tree from the game in
+    'snapshot' (with a PlaneTracker if track_planes), and return the visit counts, value sums and legality of its root's
+    edges.
+    """
+    import random
+    torch_seed, np_seed, random_seed = seed_sequence.generate_state(3).tolist()
+    torch.manual_seed(torch_seed)
+    np.random.seed(np_seed)
+    random.seed(random_seed)
+    game = Quoridor.from_snapshot(snapshot, strict_hash)
+    if track_planes:
+        PlaneTracker(game)
+    mcts = MonteCarloTreeSearch(game, pol_val_fun)
+    mcts.search(c_puct=c_puct, n_evals=n_evals)
+    store, edges = mcts._store, mcts._store.edges(mcts._root._id)
+    return store.count[edges], store.value_sum[edges], store.legal[edges]
 
 
 if __name__ == "__main__":
@@ -165,6 +782,71 @@ if __name__ == "__main__":
     tend = time.time()
 
     print("Completed", len(mcts._node_lookup), "searches in", tend-tstart, "seconds")
+    store = mcts._store
+    print("Node store uses %.0f bytes per node (%d edges per node on average), vs %d bytes for 4 dense policy planes"
+          % (store.nbytes / store.size, store._n_edges / store.size, 4 * 243 * 4))
 
-    the_act = sample_action(the_pol, mcts.player, temperature=0.0)
+    the_act = sample_action_index(the_pol, mcts.player, temperature=0.0)
     mcts.step_and_prune(the_act, verbose=True)
+
+    # Compare simulations per second with and without batched leaf evaluation, using a convolutional network.
+    layers = [torch.nn.Conv2d(6, 128, 3, padding=1), torch.nn.ReLU()]
+    for _ in range(5):
+        layers += [torch.nn.Conv2d(128, 128, 3, padding=1), torch.nn.ReLU()]
+    net = torch.nn.Sequential(*layers, torch.nn.Conv2d(128, 4, 1))
+
+    def batch_pol_val_fun(planes):
+        with torch.no_grad():
+            out = net(planes)
+        policies = torch.softmax(out[:, :3].reshape(len(planes), -1), dim=1).reshape(-1, 3, 9, 9)
+        return policies, torch.tanh(out[:, 3].mean(dim=(1, 2)))
+
+    def pol_val_fun(state):
+        policies, values = batch_pol_val_fun(encode_state_to_planes(state, add_batch=True))
+        return policies[0], values[0]
+
+    for batch_size in [1, 8, 32]:
+        mcts = MonteCarloTreeSearch(Quoridor(), pol_val_fun, batch_pol_val_fun)
+        tstart = time.time()
+        mcts.search(c_puct=2, n_evals=1000, batch_size=batch_size)
+        print("batch size %2d: %6.0f simulations per second" % (batch_size, 1000 / (time.time() - tstart)))
+
+    # Threads overlap one another's network evaluations (during which PyTorch releases the GIL) with tree traversal.
+    # Limit PyTorch to one thread per evaluation so that it does not compete with the search threads for cores.
+    torch.set_num_threads(1)
+    for n_threads in [1, 2, 4, 8]:
+        mcts = MonteCarloTreeSearch(Quoridor(), pol_val_fun)
+        tstart = time.time()
+        mcts.search(c_puct=2, n_evals=1000, n_threads=n_threads)
+        print("%d threads: %6.0f simulations per second" % (n_threads, 1000 / (time.time() - tstart)))
+
+    # Root-parallel search over 1..N processes, with a rollout evaluator: a short random playout of pawn moves, scored
+    # by the difference in path lengths.
+    import os
+    from features import simple_value
+
+    def rollout_pol_val_fun(state):
+        player, n_moves = state.current_player, 0
+        while n_moves < 8 and state.get_winner() is None:
+            moves = state.legal_pawn_moves()
+            state.exec_move(moves[np.random.randint(len(moves))], check_legal=False)
+            n_moves += 1
+        value = np.tanh(simple_value(state, player) / 10)
+        for _ in range(n_moves):
+            state.undo(allow_redo=False)
+        return torch.ones(POLICY_SHAPE) / 243, value
+
+    for n_workers in range(1, max(2, os.cpu_count() or 1) + 1):
+        mcts = MonteCarloTreeSearch(Quoridor(), rollout_pol_val_fun)
+        tstart = time.time()
+        mcts.search(c_puct=2, n_evals=1000, n_workers=n_workers, seed=0)
+        print("%d workers: %6.0f simulations per second" % (n_workers, 1000 / (time.time() - tstart)))
+
+    # Repeated searches from the opening, as in self-play, with and without an evaluation cache of the network.
+    for fun in [pol_val_fun, EvaluationCache(pol_val_fun)]:
+        tstart = time.time()
+        for _ in range(4):
+            MonteCarloTreeSearch(Quoridor(), fun).search(c_puct=2, n_evals=250)
+        hit_rate = fun.hit_rate if isinstance(fun, EvaluationCache) else 0.0
+        print("%-15s: %6.0f simulations per second, hit rate %.2f" %
+              (type(fun).__name__, 1000 / (time.time() - tstart), hit_rate))
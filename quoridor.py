@@ -1,4 +1,5 @@
-from graph_util import PathGraph
+import random
+from graph_util import PathGraph, CutSetIndex
 
 
 def parse_loc(loc_str):
@@ -127,6 +128,100 @@ for wall in ALL_WALLS:
 # Construct sets of goal positions. Player 0 begins at (0, 4) and tries to get to the last row. Player 1 is reversed.
 GOALS = [set((BOARD_SIZE-1, col) for col in range(BOARD_SIZE)), set((0, col) for col in range(BOARD_SIZE))]
 
+# Actions may also be referred to by an integer index into a flattened (3, 9, 9) policy tensor (see quornn). Index
+# plane*81 + row*9 + col is a pawn move to (row, col) for plane 0, and the horizontal (plane 1) or vertical (plane 2)
+# wall whose top-left corner is at (row, col). Indices are in board coordinates, i.e. from the perspective of player 0.
+N_ACTIONS = 3 * BOARD_SIZE * BOARD_SIZE
+# Map from action string to index, and from index to the pawn destination (row, col) or wall string for that action.
+# Slots in the last row or column of the wall planes are not real walls, and map to None.
+ACTION_INDEX = {}
+ACTION_TARGETS = [None] * N_ACTIONS
+for row in range(BOARD_SIZE):
+    for col in range(BOARD_SIZE):
+        idx = row * BOARD_SIZE + col
+        ACTION_INDEX[encode_loc(row, col)] = idx
+        ACTION_TARGETS[idx] = (row, col)
+for wall in ALL_WALLS:
+    (row, col) = parse_loc(wall[0:2])
+    idx = (1 if wall[2] == 'h' else 2) * BOARD_SIZE * BOARD_SIZE + row * BOARD_SIZE + col
+    ACTION_INDEX[wall] = idx
+    ACTION_TARGETS[idx] = wall
+
+# Policies are always expressed from the perspective of the player to move, with rows flipped for player 1 (see
+# quornn.flip_y_perspective). PERSPECTIVE_INDEX[player][idx] maps a board index to a perspective index and, since the
+# flip is its own inverse, back again. Vertical walls are labeled by their top row, so they flip to 7-row rather than
+# 8-row; the unused last row of that plane maps to itself.
+PERSPECTIVE_INDEX = [list(range(N_ACTIONS)), [0] * N_ACTIONS]
+for idx in range(N_ACTIONS):
+    plane, row, col = idx // (BOARD_SIZE * BOARD_SIZE), (idx // BOARD_SIZE) % BOARD_SIZE, idx % BOARD_SIZE
+    if plane < 2:
+        row = BOARD_SIZE - 1 - row
+    elif row < BOARD_SIZE - 1:
+        row = BOARD_SIZE - 2 - row
+    PERSPECTIVE_INDEX[1][idx] = plane * BOARD_SIZE * BOARD_SIZE + row * BOARD_SIZE + col
+
+# Random 64-bit keys for Zobrist hashing (see Quoridor.hash_key): one per wall, per (player, square), per (player,
+# number of walls remaining), and one that is toggled whenever the side to move changes. The fixed seed keeps keys
+# identical across processes, so hashes may be shared between workers.
+_zobrist_rng = random.Random(20180101)
+ZOBRIST_WALLS = {wall: _zobrist_rng.getrandbits(64) for wall in sorted(ALL_WALLS)}
+ZOBRIST_PAWNS = [{(row, col): _zobrist_rng.getrandbits(64) for row in range(BOARD_SIZE) for col in range(BOARD_SIZE)}
+                 for _ in range(2)]
+ZOBRIST_WALL_COUNTS = [[_zobrist_rng.getrandbits(64) for _ in range(11)] for _ in range(2)]
+ZOBRIST_TO_MOVE = _zobrist_rng.getrandbits(64)
+
+# Pawn-move tables. Squares are identified by the id row*9+col (which is also the action index of moving there), and
+# the walls around a square by a 4-bit mask of the directions a pawn may step from it: bit 0 up, 1 down, 2 left and
+# 3 right. A step that would leave the board is never open.
+SQUARE_NAMES = [encode_loc(sq // BOARD_SIZE, sq % BOARD_SIZE) for sq in range(BOARD_SIZE * BOARD_SIZE)]
+STEP_OFFSETS = (-BOARD_SIZE, BOARD_SIZE, -1, 1)
+# The two sideways steps available when a straight jump in each direction is blocked.
+PERPENDICULAR_STEPS = ((2, 3), (2, 3), (0, 1), (0, 1))
+INITIAL_STEP_MASKS = [(row > 0) | (row < BOARD_SIZE-1) << 1 | (col > 0) << 2 | (col < BOARD_SIZE-1) << 3
+                      for row in range(BOARD_SIZE) for col in range(BOARD_SIZE)]
+# PAWN_STEPS[sq][mask] is the tuple of squares reachable in one step from sq given its step mask.
+PAWN_STEPS = [[tuple(sq + STEP_OFFSETS[d] for d in range(4) if mask >> d & 1) for mask in range(16)]
+              for sq in range(BOARD_SIZE * BOARD_SIZE)]
+# PAWN_JUMPS[(own, other, own_mask, other_mask)] is the tuple of legal destinations for a pawn on square 'own' when
+# the other pawn is on a neighboring square 'other' that it can step to. It is filled in on demand by pawn_jumps(),
+# since only a small fraction of the 81*4*16*16 possible keys ever occur.
+PAWN_JUMPS = {}
+
+
+def pawn_jumps(own, other, own_mask, other_mask):
+    """Look up (computing if necessary) the PAWN_JUMPS entry for the given squares and step masks.
+    """
+    key = (own, other, own_mask, other_mask)
+    if key not in PAWN_JUMPS:
+        destinations = []
+        for d in range(4):
+            if not own_mask >> d & 1:
+                continue
+            target = own + STEP_OFFSETS[d]
+            if target != other:
+                destinations.append(target)
+            elif other_mask >> d & 1:
+                # Straight jump over the other pawn.
+                destinations.append(other + STEP_OFFSETS[d])
+            else:
+                # The simple jump is blocked. Jump diagonally instead.
+                for side in PERPENDICULAR_STEPS[d]:
+                    if other_mask >> side & 1:
+                        destinations.append(other + STEP_OFFSETS[side])
+        PAWN_JUMPS[key] = tuple(destinations)
+    return PAWN_JUMPS[key]
+
+
+# Construct mapping from each wall to the (square, step bit) pairs it closes, i.e. the steps across each pair of
+# locations in WALL_CUTS, in both directions.
+WALL_STEP_BITS = {}
+for wall in ALL_WALLS:
+    WALL_STEP_BITS[wall] = []
+    for (rowA, colA), (rowB, colB) in WALL_CUTS[wall]:
+        sqA, sqB = rowA * BOARD_SIZE + colA, rowB * BOARD_SIZE + colB
+        WALL_STEP_BITS[wall].append((sqA, 1 << STEP_OFFSETS.index(sqB - sqA)))
+        WALL_STEP_BITS[wall].append((sqB, 1 << STEP_OFFSETS.index(sqA - sqB)))
+
 
 def create_adjacency_graph():
     adj = {}
@@ -180,7 +275,7 @@ class Quoridor(object):
         fully notated wall might be 'd4h' for a horizontal wall that touches d4, d5, e4, and e5
     """
 
-    def __init__(self):
+    def __init__(self, strict_hash=False):
         # Essential game properties.
         # Walls is a set of strings naming the walls that have been played.
         self.walls = set()
@@ -200,18 +295,43 @@ class Quoridor(object):
         # is to efficiently keep track of shortest paths from all positions on the board to the players' goal positions
         # as walls are added and removed that modify the graph.
         self._adjacency_graph = create_adjacency_graph()
+        # Step mask of every square (see PAWN_STEPS), kept in sync with the adjacency graph by _cut and _uncut.
+        self._step_masks = list(INITIAL_STEP_MASKS)
         self._pathgraphs = [PathGraph(self._adjacency_graph, goals) for goals in GOALS]
         # "Open" walls are ones that can be played without physically overlapping previously played walls. The set of
         # legal wall placements is usually just this set of 'open' walls, but sometimes walls are additionally ruled out
         # as illegal if they cut off all of a player's paths to any goal.
         self._open_walls = set(ALL_WALLS)
+        # Set of walls that touch at least one played wall. Only these can ever cut off a player's paths, so they are
+        # the only ones whose legality needs checking against the graph. Replaced (never mutated) by each wall.
+        self._touched_walls = frozenset()
+        # One CutSetIndex per player, built lazily by _blocks_path() to answer which walls would cut that player off
+        # from its goals. They depend only on the walls in place, so pawn moves keep them.
+        self._cut_indices = [None] * len(GOALS)
+        # Journal with one entry per wall placement of the walls it removed from _open_walls and the cut indices and
+        # touched walls from before it was played, so that undo is a pure restore.
+        self._wall_journal = []
+        # Cache of legal wall placements (ignoring the current player's wall count), as a pair of a frozenset of wall
+        # strings and a list of their action indices, or None if not yet computed for this state. Each move pushes the
+        # previous value onto _legal_journal (one entry per move, for undo to restore), and the next request derives
+        # the new value from it rather than from scratch (see _get_legal_walls).
+        self._legal_walls = None
+        self._legal_journal = []
+        # Zobrist hash of the current state, kept up to date incrementally by every move and undo. If strict_hash is
+        # True, hash_key() additionally includes the full state so that hash collisions can never alias two states.
+        self._zobrist = self._compute_zobrist()
+        self.strict_hash = strict_hash
+        # Optional observer of every pawn move and wall placement or removal, including undos, used to keep encodings
+        # of the state up to date incrementally (see quornn.PlaneTracker). None unless a tracker attaches itself.
+        self.plane_tracker = None
 
     def __eq__(self, other):
         """Return True iff the current state of this Quoridor object matches another object (ignoring history).
 
-        Note that by defining __hash__ and __eq__, Quoridor objects may be used as dictionary keys.
+        Note that by defining __hash__ and __eq__, Quoridor objects may be used as dictionary keys. Equality compares
+        the full state, so it is exact even when two states' Zobrist hashes collide.
         """
-        return isinstance(other, Quoridor) and self.hash_key() == other.hash_key()
+        return isinstance(other, Quoridor) and self._zobrist == other._zobrist and self.state_key() == other.state_key()
 
     def __ne__(self, other):
         # Avoid any confusion on != or ==
@@ -244,32 +364,33 @@ class Quoridor(object):
         if check_legal and not self.is_legal(mv):
             raise IllegalMove(mv)
         if len(mv) == 2:
-            # Move the pawn.
-            (row, col) = parse_loc(mv)
-            # History includes both current position and next position so "undo" is just a matter of grabbing item [0]
-            history_entry = (self.get_player()[0], (row, col))
-            # Each player is stored as [(row, col), num_walls]. Update their position.
-            self.get_player()[0] = (row, col)
+            self._move_pawn(parse_loc(mv))
         else:
-            # Place a wall.
-            self.walls.add(mv)
-            # Each player is stored as [(row, col), num_walls]. Subtract 1 from count of their remaining walls.
-            self.get_player()[1] -= 1
-            # Cut the adjacency graph (call 'cut' on PathGraphs for each player)
-            self._cut(mv)
-            # Record just the wall string in history.
-            history_entry = mv
-            # Update list of 'open' wall spaces.
-            self._open_walls -= INTERSECTING_WALLS[mv]
-
-        self.history.append(history_entry)
+            self._place_wall(mv)
         self.current_player = (self.current_player + 1) % len(self.players)
+        self._zobrist ^= ZOBRIST_TO_MOVE
+        if not is_redo:
+            self.redo_stack = []
+
+    def exec_move_idx(self, idx, check_legal=True, is_redo=False):
+        """Execute a move given by its action index (see ACTION_INDEX) and update the state.
+
+        Behaves exactly like exec_move(), but looks up the move in ACTION_TARGETS rather than parsing a string.
+        """
+        if check_legal and not self.is_legal_idx(idx):
+            raise IllegalMove(idx)
+        if idx < BOARD_SIZE * BOARD_SIZE:
+            self._move_pawn(ACTION_TARGETS[idx])
+        else:
+            self._place_wall(ACTION_TARGETS[idx])
+        self.current_player = (self.current_player + 1) % len(self.players)
+        self._zobrist ^= ZOBRIST_TO_MOVE
         if not is_redo:
             self.redo_stack = []
 
     def temp_move(self, mv):
         """Execute the given move in a `with` context, where it automatically undoes itself when
-           the `with` is complete.
+           the `with` is complete. The move may be a string or an action index.
         """
         return Quoridor.TempMove(self, mv)
 
@@ -281,6 +402,9 @@ class Quoridor(object):
             last_entry = self.history.pop()
             if type(last_entry) is tuple:
                 self.players[prev_player][0] = last_entry[0]
+                self._zobrist ^= ZOBRIST_PAWNS[prev_player][last_entry[1]] ^ ZOBRIST_PAWNS[prev_player][last_entry[0]]
+                if self.plane_tracker is not None:
+                    self.plane_tracker.pawn_moved(prev_player, last_entry[1], last_entry[0])
                 # Append move string to redo stack.
                 if allow_redo:
                     self.redo_stack.append(encode_loc(*last_entry[1]))
@@ -289,17 +413,21 @@ class Quoridor(object):
                 self.walls.discard(last_entry)
                 # Add 1 back to count of remaining walls.
                 self.players[prev_player][1] += 1
-                # Repair the adjacency graph.
+                count_keys, num_walls = ZOBRIST_WALL_COUNTS[prev_player], self.players[prev_player][1]
+                self._zobrist ^= ZOBRIST_WALLS[last_entry] ^ count_keys[num_walls] ^ count_keys[num_walls - 1]
+                if self.plane_tracker is not None:
+                    self.plane_tracker.wall_changed(prev_player, last_entry, num_walls, False)
+                # Repair the adjacency graph (a journaled restore in each PathGraph).
                 self._uncut(last_entry)
                 # Append wall string to redo stack.
                 if allow_redo:
                     self.redo_stack.append(last_entry)
-                # Add back in 'open' walls.
-                for maybe_open in INTERSECTING_WALLS[last_entry]:
-                    # Each of the walls touching 'last_entry' may be ruled out by some other played wall.
-                    if all(w not in self.walls for w in INTERSECTING_WALLS[maybe_open]):
-                        self._open_walls.add(maybe_open)
+                # Add back in exactly the 'open' walls that this wall closed, and the previous cut indices.
+                closed_walls, self._cut_indices, self._touched_walls = self._wall_journal.pop()
+                self._open_walls |= closed_walls
+            self._legal_walls = self._legal_journal.pop()
             self.current_player = prev_player
+            self._zobrist ^= ZOBRIST_TO_MOVE
 
     def redo(self):
         """Play forward from series of calls to undo().
@@ -318,90 +446,25 @@ class Quoridor(object):
             # Check that move is on the board
             if row < 0 or col < 0 or row > BOARD_SIZE-1 or col > BOARD_SIZE-1:
                 return False
-            # Note: we cannot simply assert that the move is 1 space away due to possible jumping situations (at most 2
-            # spaces away in a 2-player game)
-            cur_loc = self.get_player()[0]
-            other_player_locs = set([p[0] for p in self.players])
-            adjacent_player_locs = other_player_locs & self._adjacency_graph[cur_loc]
-            # Check that another player is not in the position.
-            if (row, col) in adjacent_player_locs:
-                return False
-            # Check for jumping situation if there is another player adjacent to the current player
-            if len(adjacent_player_locs) > 0:
-                for (pr, pc) in adjacent_player_locs:
-                    if pr == cur_loc[0]:
-                        # Check horizontal jump (same row).
-                        col_diff = pc - cur_loc[1]
-                        one_further = (pr, pc + col_diff)
-                        diagonals = [(pr - 1, pc), (pr + 1, pc)]
-                        if one_further in self._adjacency_graph[(pr, pc)]:
-                            if (row, col) == one_further and one_further not in other_player_locs:
-                                return True
-                        else:
-                            # The simple jump is blocked. Check diagonals.
-                            for d in diagonals:
-                                if (row, col) == d and d in self._adjacency_graph[(pr, pc)] \
-                                        and d not in other_player_locs:
-                                    return True
-                    elif pc == cur_loc[1]:
-                        # Check vertical jump (same col).
-                        row_diff = pr - cur_loc[0]
-                        one_further = (pr + row_diff, pc)
-                        diagonals = [(pr, pc - 1), (pr, pc + 1)]
-                        if one_further in self._adjacency_graph[(pr, pc)]:
-                            if (row, col) == one_further and one_further not in other_player_locs:
-                                return True
-                        else:
-                            # The simple jump is blocked. Check diagonals.
-                            for d in diagonals:
-                                if (row, col) == d and d in self._adjacency_graph[(pr, pc)] \
-                                        and d not in other_player_locs:
-                                    return True
-            # Having considered jumps, check that target is adjacent to current position, taking
-            # into account walls.
-            if (row, col) not in self._adjacency_graph[cur_loc]:
-                return False
+            return self._is_legal_pawn(row, col)
         elif len(mv) == 3:
             (row, col) = parse_loc(mv[0:2])
-            # Check that player has a wall to spare.
-            if not self.get_player()[1] > 0:
-                return False
             # Check that wall is on the board.
             if row < 0 or col < 0 or row > BOARD_SIZE-2 or col > BOARD_SIZE-2:
                 return False
-            # Check that wall does not physically intersect with any wall that has been played.
-            if mv not in self._open_walls:
-                return False
-            # (slow) check that wall does not cut off all paths to some goal for any player.
-            # Efficiency note 1: only needs to be checked if 'mv' is 'touching' to some existing wall
-            touching_wall, shortest_path_cut = False, False
-            for wall in TOUCHING_WALLS[mv]:
-                if wall in self.walls:
-                    touching_wall = True
-                    break
-            # Efficiency note 2: we may skip checking this wall if it doesn't cut any player's shortest path.
-            if touching_wall:
-                cuts = WALL_CUTS[mv]
-                for (player, graph) in zip(self.players, self._pathgraphs):
-                    current = player[0]
-                    for next in graph.get_path(current):
-                        if [current, next] in cuts or [next, current] in cuts:
-                            # The wall cuts this player's path..
-                            shortest_path_cut = True
-                            break
-                        current = next
-                    if shortest_path_cut:
-                        break
-            # After 2 tests, it's plausible that this wall cuts off a player. Do a full (slow) call to cut() to check.
-            if touching_wall and shortest_path_cut:
-                self._cut(mv)
-                has_path = all(graph.has_path(player[0]) for (player, graph) in zip(self.players, self._pathgraphs))
-                self._uncut(mv)
-                return has_path
-            return True
+            return self._is_legal_wall(mv)
         else:
             return False
-        return True
+
+    def is_legal_idx(self, idx):
+        """Return True iff the move with the given action index is legal.
+        """
+        if idx < 0 or idx >= N_ACTIONS or ACTION_TARGETS[idx] is None:
+            return False
+        elif idx < BOARD_SIZE * BOARD_SIZE:
+            return self._is_legal_pawn(*ACTION_TARGETS[idx])
+        else:
+            return self._is_legal_wall(ACTION_TARGETS[idx])
 
     def get_winner(self):
         """Return the index of the winning player, or None if nobody has won yet.
@@ -412,14 +475,7 @@ class Quoridor(object):
         return None
 
     def all_legal_moves(self, partial_check=False):
-        (row, col) = self.get_player()[0]
-        legal_moves = []
-        # Only check moves within +/- 2 spaces of the pawn (in case jump is legal)
-        for r in range(max(0, row - 2), min(BOARD_SIZE-1, row + 2) + 1):
-            for c in range(max(0, col - 2), min(BOARD_SIZE-1, col + 2) + 1):
-                mv = encode_loc(r, c)
-                if self.is_legal(mv):
-                    legal_moves.append(mv)
+        legal_moves = self.legal_pawn_moves()
         # If no walls available, just return legal moves
         if self.get_player()[1] == 0:
             return legal_moves
@@ -428,9 +484,53 @@ class Quoridor(object):
         if partial_check:
             legal_walls = list(self._open_walls)
         else:
-            legal_walls = [w for w in self._open_walls if self.is_legal(w)]
+            legal_walls = list(self._get_legal_walls()[0])
         return legal_moves + legal_walls
 
+    def legal_action_indices(self, partial_check=False):
+        """Same as all_legal_moves(), but returns the list of action indices (see ACTION_INDEX) of all legal moves.
+        """
+        # A pawn move's action index is the same as the id of its destination square.
+        legal_indices = list(self._pawn_destinations())
+        if self.get_player()[1] == 0:
+            return legal_indices
+        if partial_check:
+            legal_indices.extend(ACTION_INDEX[w] for w in self._open_walls)
+        else:
+            legal_indices.extend(self._get_legal_walls()[1])
+        return legal_indices
+
+    def legal_pawn_moves(self):
+        """Return the list of legal pawn moves (including jumps) for the current player.
+        """
+        return [SQUARE_NAMES[sq] for sq in self._pawn_destinations()]
+
+    def iter_legal_walls(self, key=None):
+        """Generator of the current player's legal walls, in increasing order of key(wall) if a key function is given.
+
+        Unlike all_legal_moves(), a wall's legality is only checked against the graph when it is about to be yielded,
+        so a consumer that stops early (e.g. on a beta cutoff) never pays for the walls it did not look at. Moves may be
+        made between steps of the generator as long as they are undone before the next step.
+        """
+        if self.get_player()[1] == 0:
+            return
+        # Iterate over a copy since moves made by the consumer temporarily change _open_walls.
+        walls = sorted(self._open_walls, key=key) if key is not None else list(self._open_walls)
+        for wall in walls:
+            if self._legal_walls is not None:
+                if wall in self._legal_walls[0]:
+                    yield wall
+            elif wall not in self._touched_walls or not self._blocks_path(wall):
+                yield wall
+
+    def iter_legal_moves(self, key=None):
+        """Generator of all legal moves: pawn moves first, then walls as in iter_legal_walls(key).
+        """
+        for mv in self.legal_pawn_moves():
+            yield mv
+        for wall in self.iter_legal_walls(key):
+            yield wall
+
     def get_player(self, player_idx=None):
         """Return the [(row, col), num_walls] list of state for the current player (or the player at index player_idx).
 
@@ -445,7 +545,18 @@ class Quoridor(object):
         return self._pathgraphs[self.current_player if player_idx is None else player_idx]
 
     def hash_key(self):
-        """Create a unique identifier for the present state of the game (history-free).
+        """Return an identifier for the present state of the game (history-free) in O(1).
+
+        This is the 64-bit Zobrist hash of the state, covering walls, pawn squares, wall counts and the side to move.
+        Distinct states collide with negligible probability; if the game was created with strict_hash=True, the key is
+        instead a (hash, state_key()) tuple, which is slower to build but guaranteed unique.
+        """
+        if self.strict_hash:
+            return (self._zobrist, self.state_key())
+        return self._zobrist
+
+    def state_key(self):
+        """Create a unique identifier for the present state of the game (history-free) from the full state.
 
         A hashable key must be immutable, hence the use of tuples and frozen sets.
         """
@@ -483,21 +594,159 @@ class Quoridor(object):
                 game.undo(allow_redo=True)
         return game
 
+    def snapshot(self):
+        """Return a compact, picklable snapshot of the game: its history as a bytes object of action indices (see
+        ACTION_INDEX), one byte per move. Restore it with Quoridor.from_snapshot().
+        """
+        return bytes(mv[1][0] * BOARD_SIZE + mv[1][1] if type(mv) is tuple else ACTION_INDEX[mv] for mv in self.history)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, strict_hash=False):
+        """Create a game from the output of snapshot() by replaying its moves (without checking their legality).
+        """
+        game = cls(strict_hash=strict_hash)
+        for idx in snapshot:
+            game.exec_move_idx(idx, check_legal=False)
+        return game
+
     ####################
     # HELPER FUNCTIONS #
     ####################
 
+    def _pawn_destinations(self):
+        """Return the tuple of squares (see PAWN_STEPS) that the current player's pawn may legally move to, including
+        jumps, by table lookup.
+        """
+        (row, col), (other_row, other_col) = self.get_player()[0], self.players[1 - self.current_player][0]
+        own, other = row * BOARD_SIZE + col, other_row * BOARD_SIZE + other_col
+        destinations = PAWN_STEPS[own][self._step_masks[own]]
+        if other in destinations:
+            destinations = pawn_jumps(own, other, self._step_masks[own], self._step_masks[other])
+        return destinations
+
+    def _is_legal_pawn(self, row, col):
+        """Return True iff moving the current player's pawn to the on-board location (row, col) is legal.
+        """
+        return row * BOARD_SIZE + col in self._pawn_destinations()
+
+    def _is_legal_wall(self, mv):
+        """Return True iff placing the on-board wall 'mv' is legal.
+        """
+        # Check that player has a wall to spare.
+        if not self.get_player()[1] > 0:
+            return False
+        # If the legal walls have already been computed for this state, they answer the remaining checks.
+        if self._legal_walls is not None:
+            return mv in self._legal_walls[0]
+        # Check that wall does not physically intersect with any wall that has been played.
+        if mv not in self._open_walls:
+            return False
+        # Check that wall does not cut off all paths to some goal for any player.
+        # Efficiency note: only needs to be checked if 'mv' is 'touching' to some existing wall
+        return mv not in self._touched_walls or not self._blocks_path(mv)
+
+    def _blocks_path(self, wall):
+        """Return True iff placing 'wall' would cut off some player from all of its goals.
+
+        Rather than cutting and uncutting the graph for each wall, this queries a CutSetIndex per player, which costs
+        one traversal of the graph to build (once per set of walls) and O(1) per wall afterwards.
+        """
+        cuts = WALL_CUTS[wall]
+        for i, player in enumerate(self.players):
+            if self._cut_indices[i] is None:
+                self._cut_indices[i] = CutSetIndex(self._adjacency_graph, GOALS[i])
+            if self._cut_indices[i].separates(player[0], cuts):
+                return True
+        return False
+
+    def _get_legal_walls(self):
+        """Return the (frozenset of wall strings, list of action indices) pair of legal wall placements, ignoring the
+        current player's wall count, computing it if it is not already cached.
+
+        Walls that touch no played wall are always legal, so only touched walls are ever checked against the graph.
+        Adding a wall only removes paths, so if the last move was a wall and the previous state's legal walls are
+        known, only those of them that are still open need rechecking. This is done on demand rather than in exec_move
+        so that leaves of a search, whose moves are never generated, cost nothing.
+        """
+        if self._legal_walls is None:
+            parent = self._legal_journal[-1] if len(self._legal_journal) > 0 else None
+            if parent is not None and type(self.history[-1]) is not tuple:
+                candidates = parent[0] - self._wall_journal[-1][0]
+            else:
+                candidates = self._open_walls
+            self._legal_walls = self._compute_legal_walls(candidates - self._touched_walls,
+                                                          candidates & self._touched_walls)
+        return self._legal_walls
+
+    def _compute_legal_walls(self, free, candidates):
+        """Return the (frozenset, list) pair of legal walls given a set of 'free' walls already known to be legal and a
+        set of open 'candidates' that must be checked against the graph.
+        """
+        legal = free.union(w for w in candidates if not self._blocks_path(w))
+        return frozenset(legal), [ACTION_INDEX[w] for w in legal]
+
+    def _move_pawn(self, loc):
+        """Move the current player's pawn to loc, recording history.
+        """
+        # History includes both current position and next position so "undo" is just a matter of grabbing item [0]
+        self.history.append((self.get_player()[0], loc))
+        pawn_keys = ZOBRIST_PAWNS[self.current_player]
+        self._zobrist ^= pawn_keys[self.get_player()[0]] ^ pawn_keys[loc]
+        if self.plane_tracker is not None:
+            self.plane_tracker.pawn_moved(self.current_player, self.get_player()[0], loc)
+        # Each player is stored as [(row, col), num_walls]. Update their position.
+        self.get_player()[0] = loc
+        self._legal_journal.append(self._legal_walls)
+        self._legal_walls = None
+
+    def _place_wall(self, wall):
+        """Place a wall for the current player, recording history.
+        """
+        self.walls.add(wall)
+        # Each player is stored as [(row, col), num_walls]. Subtract 1 from count of their remaining walls.
+        self.get_player()[1] -= 1
+        count_keys = ZOBRIST_WALL_COUNTS[self.current_player]
+        self._zobrist ^= ZOBRIST_WALLS[wall] ^ count_keys[self.get_player()[1] + 1] ^ count_keys[self.get_player()[1]]
+        if self.plane_tracker is not None:
+            self.plane_tracker.wall_changed(self.current_player, wall, self.get_player()[1], True)
+        # Cut the adjacency graph (call 'cut' on PathGraphs for each player)
+        self._cut(wall)
+        # Record just the wall string in history.
+        self.history.append(wall)
+        # Update list of 'open' wall spaces, journaling which ones were closed by this wall.
+        closed_walls = self._open_walls & INTERSECTING_WALLS[wall]
+        self._open_walls -= closed_walls
+        self._wall_journal.append((closed_walls, self._cut_indices, self._touched_walls))
+        self._cut_indices = [None] * len(GOALS)
+        self._touched_walls = self._touched_walls.union(TOUCHING_WALLS[wall])
+        self._legal_journal.append(self._legal_walls)
+        self._legal_walls = None
+
+    def _compute_zobrist(self):
+        """Compute the Zobrist hash of the current state from scratch (see hash_key).
+        """
+        key = ZOBRIST_TO_MOVE if self.current_player == 1 else 0
+        for wall in self.walls:
+            key ^= ZOBRIST_WALLS[wall]
+        for i, (loc, num_walls) in enumerate(self.players):
+            key ^= ZOBRIST_PAWNS[i][loc] ^ ZOBRIST_WALL_COUNTS[i][num_walls]
+        return key
+
     def _cut(self, wall):
         """Cut the adjacency graph with the given wall.
         """
         for graph in self._pathgraphs:
             graph.cut(WALL_CUTS[wall])
+        for (sq, bit) in WALL_STEP_BITS[wall]:
+            self._step_masks[sq] &= ~bit
 
     def _uncut(self, wall):
         """Repair adjacency graph (undo `_cut(wall)`)
         """
         for graph in self._pathgraphs:
             graph.uncut(WALL_CUTS[wall])
+        for (sq, bit) in WALL_STEP_BITS[wall]:
+            self._step_masks[sq] |= bit
 
     class TempMove:
         """Class providing do/undo functionality in a with statement.
@@ -517,10 +766,13 @@ class Quoridor(object):
         def __enter__(self, check_legal=False):
             # __enter__ is called when the with statement begins. Execute the move with is_redo set to True as a hack to
             # prevent overwriting the redo stack
-            # TODO - cache
-            self.game.exec_move(self.mv, check_legal=check_legal, is_redo=True)
+            if type(self.mv) is int:
+                self.game.exec_move_idx(self.mv, check_legal=check_legal, is_redo=True)
+            else:
+                self.game.exec_move(self.mv, check_legal=check_legal, is_redo=True)
             return self.game
 
         def __exit__(self, type, value, traceback):
-            # __exit__ is called when the with statement ends. Undo the move without touching the redo stack.
+            # __exit__ is called when the with statement ends. Undo the move without touching the redo stack. Since
+            # exec_move journals everything it changes, this is a pure restore.
             self.game.undo(allow_redo=False)
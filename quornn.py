@@ -1,12 +1,14 @@
+import numpy as np
 import torch
-from quoridor import encode_loc, parse_loc, Quoridor
-from typing import Iterable, Union
+from quoridor import encode_loc, parse_loc, Quoridor, ACTION_INDEX, PERSPECTIVE_INDEX, ALL_WALLS, BOARD_SIZE
+from typing import Iterable, Sequence, Union
 
 # TODO - extend to 4-player games? All functions here currently assume 2-player
-# TODO - make batch operations
 
 STATE_SHAPE = (6, 9, 9)
 POLICY_SHAPE = (3, 9, 9)
+# PERSPECTIVE_INDEX as a tensor, for flipping whole batches of action indices at once.
+PERSPECTIVE_INDEX_TENSOR = torch.tensor(PERSPECTIVE_INDEX, dtype=torch.long)
 
 def flip_y_perspective(row:int, current_player:int, is_vwall:bool=False)->int:
     """Flip row coordinates for player 1 so that -- no matter who the 'current player' is -- the enemy's gate is down.
@@ -23,6 +25,21 @@ def flip_y_perspective(row:int, current_player:int, is_vwall:bool=False)->int:
     else:
         return 8-row
 
+# Flat indices into a (6 x 9 x 9) state tensor, from each player's perspective, of the cell of each square on plane 0
+# and of the two cells covered by each wall on plane 4 (horizontal) or 5 (vertical). See encode_states_to_planes.
+_SQUARE_CELLS = [[[flip_y_perspective(row, player) * BOARD_SIZE + col for col in range(BOARD_SIZE)]
+                  for row in range(BOARD_SIZE)] for player in range(2)]
+_WALL_CELLS = [{}, {}]
+for _wall in ALL_WALLS:
+    _row, _col = parse_loc(_wall[:2])
+    for _player in range(2):
+        if _wall[2] == 'h':
+            _cell = 4 * 81 + flip_y_perspective(_row, _player) * BOARD_SIZE + _col
+            _WALL_CELLS[_player][_wall] = (_cell, _cell + 1)
+        else:
+            _cell = 5 * 81 + flip_y_perspective(_row, _player, True) * BOARD_SIZE + _col
+            _WALL_CELLS[_player][_wall] = (_cell, _cell + BOARD_SIZE)
+
 def encode_state_to_planes(game:Quoridor, add_batch=False, out:torch.Tensor=None) -> torch.Tensor:
     """Encode an instance of a Quoridor object into feature planes for input into a neural net.
 
@@ -35,36 +52,119 @@ def encode_state_to_planes(game:Quoridor, add_batch=False, out:torch.Tensor=None
     wall locations, and one for vertical wall locations. The 'current' player is always on plane 0 with goals at the
     last row, and the 'other' player is on plane 1 with goals at the 0th row.
     """
+    if out is None:
+        out = torch.zeros(STATE_SHAPE)
+    if game.plane_tracker is not None:
+        out.copy_(game.plane_tracker.planes(game.current_player))
+    else:
+        encode_states_to_planes((game,), out=out.unsqueeze(0))
+
+    if add_batch:
+        return out.unsqueeze(0)
+    else:
+        return out
 
+def encode_states_to_planes(games:Sequence[Quoridor], out:torch.Tensor=None, dtype=torch.float32) -> torch.Tensor:
+    """Encode a batch of games into a (len(games) x 6 x 9 x 9) tensor, each as in encode_state_to_planes.
+
+    The cells to set are gathered from precomputed tables as flat indices and written with a single scatter. If out
+    (a contiguous tensor of that shape) is given it is filled in place, else a new tensor of type dtype is created. A
+    compact torch.uint8 dtype is enough to store any state. Games with a PlaneTracker are copied from it instead.
+    """
     if out is None:
-        out = torch.zeros(6, 9, 9)
+        out = torch.zeros((len(games),) + STATE_SHAPE, dtype=dtype)
     else:
-        out.fill_(0.0)
+        out.fill_(0)
 
-    # Current player on out 0 and 1
-    (cur_row, cur_col), cur_walls = game.players[game.current_player]
-    out[0, flip_y_perspective(cur_row, game.current_player), cur_col] = 1
-    out[1, :, :] = cur_walls
+    cells, n_cells, wall_counts, tracked = [], [], [], []
+    for i, game in enumerate(games):
+        player = game.current_player
+        if game.plane_tracker is not None:
+            tracked.append(i)
+            n_cells.append(0)
+        else:
+            n_before = len(cells)
+            _add_state_cells(game, player, cells)
+            n_cells.append(len(cells) - n_before)
+        wall_counts.append((game.players[player][1], game.players[1-player][1]))
 
-    # Other player(s) on planes 2 and 3
-    (other_row, other_col), other_walls = game.players[1-game.current_player]
-    out[2, flip_y_perspective(other_row, game.current_player), other_col] = 1
-    out[3, :, :] = other_walls
+    batch = torch.repeat_interleave(torch.arange(len(games)), torch.tensor(n_cells, dtype=torch.long))
+    out.view(len(games), -1)[batch, torch.tensor(cells, dtype=torch.long)] = 1
+    out[:, 1:4:2] = torch.tensor(wall_counts, dtype=out.dtype).view(-1, 2, 1, 1)
+    for i in tracked:
+        out[i].copy_(games[i].plane_tracker.planes(games[i].current_player))
+    return out
 
-    # Horizontal walls on plane 4, vertical walls on plane 5, again oriented to the perspective of the current player
+def _add_state_cells(game:Quoridor, player:int, cells:list):
+    """Append to 'cells' the flat indices of the cells of both pawns and all walls in the state planes of 'game' from
+    the perspective of 'player'.
+    """
+    (cur_row, cur_col), (other_row, other_col) = game.players[player][0], game.players[1-player][0]
+    cells.append(_SQUARE_CELLS[player][cur_row][cur_col])
+    cells.append(2 * 81 + _SQUARE_CELLS[player][other_row][other_col])
+    wall_cells = _WALL_CELLS[player]
     for w in game.walls:
-        (row, col) = parse_loc(w[:2])
-        if w[2] == 'h':
-            out[4, flip_y_perspective(row, game.current_player), col] = 1
-            out[4, flip_y_perspective(row, game.current_player), col+1] = 1
-        elif w[2] == 'v':
-            out[5, flip_y_perspective(row, game.current_player, True), col] = 1
-            out[5, flip_y_perspective(row, game.current_player, True)+1, col] = 1
+        cells.extend(wall_cells[w])
 
-    if add_batch:
-        return out.unsqueeze(0)
-    else:
-        return out
+# Flat indices into the (2 x 6 x 9 x 9) planes of a PlaneTracker of the cells that change when a pawn of each player
+# enters or leaves each square, and when each wall is placed or removed, and of the wall-count planes of each player.
+_TRACKED_PAWN_CELLS = [{(row, col): (_SQUARE_CELLS[0][row][col] + (0 if player == 0 else 2 * 81),
+                                     6 * 81 + _SQUARE_CELLS[1][row][col] + (0 if player == 1 else 2 * 81))
+                        for row in range(BOARD_SIZE) for col in range(BOARD_SIZE)} for player in range(2)]
+_TRACKED_WALL_CELLS = {wall: _WALL_CELLS[0][wall] + tuple(6 * 81 + cell for cell in _WALL_CELLS[1][wall])
+                       for wall in ALL_WALLS}
+_TRACKED_COUNT_PLANES = [(1 * 81, 6 * 81 + 3 * 81), (3 * 81, 6 * 81 + 1 * 81)]
+
+class PlaneTracker(object):
+    """The state planes of a game (see encode_state_to_planes) from both players' perspectives, kept up to date by the
+    game's moves and undos rather than encoded from scratch: a pawn move changes two cells of each perspective's planes,
+    and a wall two cells and one wall-count plane.
+
+    Creating a tracker attaches it to the game (as game.plane_tracker); set that back to None to detach it. Once
+    attached, encode_state_to_planes and encode_states_to_planes encode the game with a single copy, and planes(player)
+    is a zero-copy view.
+    """
+    def __init__(self, game:Quoridor, dtype=np.float32):
+        # The planes are stored in a numpy array, whose single-element writes are much cheaper than a tensor's, and
+        # exposed as a tensor sharing its memory.
+        self._planes = np.zeros((2,) + STATE_SHAPE, dtype=dtype)
+        self._flat = self._planes.reshape(-1)
+        self.tensor = torch.from_numpy(self._planes)
+        for player in range(2):
+            cells = []
+            _add_state_cells(game, player, cells)
+            self._planes[player].reshape(-1)[cells] = 1
+            self._planes[player, 1] = game.players[player][1]
+            self._planes[player, 3] = game.players[1-player][1]
+        game.plane_tracker = self
+
+    def __getstate__(self):
+        # _flat and tensor share the memory of _planes, which copying or pickling them separately would not preserve.
+        return {'_planes': self._planes}
+
+    def __setstate__(self, state):
+        self._planes = state['_planes']
+        self._flat = self._planes.reshape(-1)
+        self.tensor = torch.from_numpy(self._planes)
+
+    def planes(self, player:int) -> torch.Tensor:
+        """Return the (6 x 9 x 9) state planes from the perspective of 'player', as a view that changes with the game.
+        """
+        return self.tensor[player]
+
+    def pawn_moved(self, player:int, old_loc:tuple, new_loc:tuple):
+        flat, cells = self._flat, _TRACKED_PAWN_CELLS[player]
+        old_a, old_b = cells[old_loc]
+        new_a, new_b = cells[new_loc]
+        flat[old_a] = flat[old_b] = 0
+        flat[new_a] = flat[new_b] = 1
+
+    def wall_changed(self, player:int, wall:str, num_walls:int, placed:bool):
+        flat = self._flat
+        a, b, c, d = _TRACKED_WALL_CELLS[wall]
+        flat[a] = flat[b] = flat[c] = flat[d] = placed
+        start_a, start_b = _TRACKED_COUNT_PLANES[player]
+        flat[start_a:start_a + 81] = flat[start_b:start_b + 81] = num_walls
 
 def action_to_coordinate(action:str, current_player:int) -> tuple:
     """Given an action string (like 'b4' for pawn movement or 'd4h' for a wall), return the (plane, row, col) index into
@@ -100,14 +200,61 @@ def encode_actions_to_planes(actions:Union[Iterable[str], str], current_player:i
         actions = (actions,)
 
     # Encode each action in the list with a '1'
+    indices = []
+    for move in actions:
+        if move not in ACTION_INDEX:
+            raise ValueError("Invalid action: {}".format(move))
+        indices.append(ACTION_INDEX[move])
+    return encode_action_indices_to_planes(indices, current_player, out=out)
+
+def encode_action_indices_to_planes(action_indices:Iterable[int], current_player:int, out:torch.Tensor=None) \
+        -> torch.Tensor:
+    """Same as encode_actions_to_planes, but for action indices (see quoridor.ACTION_INDEX) rather than strings.
+    """
     if out is None:
         out = torch.zeros(3, 9, 9)
     else:
         out.fill_(0.0)
-    for move in actions:
-        out[action_to_coordinate(move, current_player)] = 1
+    action_indices = torch.as_tensor(action_indices, dtype=torch.long)
+    out.view(-1)[PERSPECTIVE_INDEX_TENSOR[current_player, action_indices]] = 1
     return out
 
+def encode_action_indices_to_masks(action_indices:Sequence[Iterable[int]], current_players:Sequence[int],
+                                   out:torch.Tensor=None) -> torch.Tensor:
+    """Batch version of encode_action_indices_to_planes: given a list of B collections of action indices (e.g. the legal
+    actions of B positions, see Quoridor.legal_action_indices) and the B players they are from the perspective of,
+    return the (B x 3 x 9 x 9) boolean mask of those actions in each player's policy planes.
+
+    All actions are flipped to their players' perspectives by indexing PERSPECTIVE_INDEX_TENSOR, and written with a
+    single scatter. If out (a contiguous tensor of that shape) is given it is filled in place.
+    """
+    if out is None:
+        out = torch.zeros((len(action_indices),) + POLICY_SHAPE, dtype=torch.bool)
+    else:
+        out.fill_(0)
+    counts = torch.tensor([len(indices) for indices in action_indices], dtype=torch.long)
+    flat = torch.tensor([idx for indices in action_indices for idx in indices], dtype=torch.long)
+    batch = torch.repeat_interleave(torch.arange(len(action_indices)), counts)
+    players = torch.repeat_interleave(torch.as_tensor(current_players, dtype=torch.long), counts)
+    out.view(len(action_indices), -1)[batch, PERSPECTIVE_INDEX_TENSOR[players, flat]] = 1
+    return out
+
+def _sample_index(policy_planes:torch.Tensor, temperature:float) -> int:
+    """Sample a flat index into policy_planes, or take the argmax if temperature is ~0.
+    """
+    if temperature < 1e-6:
+        # Do max operation instead of unstable low-temperature manipulations
+        idx = torch.argmax(policy_planes)
+    else:
+        idx = torch.multinomial(policy_planes.flatten()**temperature, num_samples=1)
+    return idx.item()
+
+def sample_action_index(policy_planes:torch.Tensor, current_player:int, temperature=1.0) -> int:
+    """Same as sample_action, but returns the action index (see quoridor.ACTION_INDEX) in board coordinates rather than
+    an action string, so no strings are formatted or parsed.
+    """
+    return PERSPECTIVE_INDEX[current_player][_sample_index(policy_planes, temperature)]
+
 def sample_action(policy_planes:torch.Tensor, current_player:int, temperature=1.0) -> str:
     """Sample an action from the given (3 x 9 x 9) policy. Behavior depends on the current_player because the policy is
     always from the perspective of the current player, while actions are in global board coordinates.
@@ -133,12 +280,7 @@ def sample_action(policy_planes:torch.Tensor, current_player:int, temperature=1.
         else:
             return encode_loc(flip_y_perspective(row, current_player, True), col)+"v"
 
-    if temperature < 1e-6:
-        # Do max operation instead of unstable low-temperature manipulations
-        idx = torch.argmax(policy_planes)
-    else:
-        idx = torch.multinomial(policy_planes.flatten()**temperature, num_samples=1)
-    return _idx_to_action(idx.item())
+    return _idx_to_action(_sample_index(policy_planes, temperature))
 
 if __name__ == '__main__':
     # mini test
@@ -155,6 +297,10 @@ if __name__ == '__main__':
         mv2 = sample_action(planes, 0)
         print(mv2)
         assert mv2 == mv, "Failed to encode/decode {}".format(mv)
+        for player in [0, 1]:
+            planes = encode_action_indices_to_planes([ACTION_INDEX[mv]], player)
+            assert torch.all(planes == encode_actions_to_planes(mv, player)), "Index encoding mismatch {}".format(mv)
+            assert sample_action_index(planes, player) == ACTION_INDEX[mv], "Failed to decode index {}".format(mv)
 
     # Test that just sampling random moves leads to some illegal moves getting selected (this is expected)
     random_actions, masked_random_actions = ['']*100, ['']*100
@@ -192,3 +338,50 @@ if __name__ == '__main__':
     # Test that walls are vertically flipped between two players' perspectives
     assert torch.all(planes0[4] == torch.flipud(planes1[4]))
     assert torch.all(planes0[5] == torch.flipud(planes1[5]))
+
+    # Time encoding a batch of positions one at a time against a single batch encoding.
+    import random
+    import time
+    rng = random.Random(0)
+    games = []
+    for _ in range(256):
+        game = Quoridor()
+        for _ in range(rng.randrange(20)):
+            game.exec_move(rng.choice(sorted(game.all_legal_moves())))
+        games.append(game)
+    batch = torch.zeros((len(games),) + STATE_SHAPE)
+    tstart = time.time()
+    for i, game in enumerate(games):
+        encode_state_to_planes(game, out=batch[i])
+    print("encode_state_to_planes:  %5.1f us per state" % (1e6 * (time.time() - tstart) / len(games)))
+    tstart = time.time()
+    encode_states_to_planes(games, out=batch)
+    print("encode_states_to_planes: %5.1f us per state" % (1e6 * (time.time() - tstart) / len(games)))
+    tstart = time.time()
+    for i, game in enumerate(games):
+        PlaneTracker(game)
+    print("PlaneTracker setup:      %5.1f us per state" % (1e6 * (time.time() - tstart) / len(games)))
+    tstart = time.time()
+    for i, game in enumerate(games):
+        encode_state_to_planes(game, out=batch[i])
+    print("with PlaneTracker:       %5.1f us per state" % (1e6 * (time.time() - tstart) / len(games)))
+    # Legal move masks of the whole batch, from move strings one position at a time and with a single scatter
+    legal_moves = [game.all_legal_moves() for game in games]
+    legal_indices = [game.legal_action_indices() for game in games]
+    tstart = time.time()
+    for game, moves in zip(games, legal_moves):
+        encode_actions_to_planes(moves, game.current_player)
+    print("encode_actions_to_planes:       %5.1f us per state" % (1e6 * (time.time() - tstart) / len(games)))
+    tstart = time.time()
+    encode_action_indices_to_masks(legal_indices, [game.current_player for game in games])
+    print("encode_action_indices_to_masks: %5.1f us per state" % (1e6 * (time.time() - tstart) / len(games)))
+    # Cost of a move and its undo, with and without a tracker
+    game = games[-1]
+    move = game.legal_action_indices()[0]
+    for tracker in [None, game.plane_tracker]:
+        game.plane_tracker = tracker
+        tstart = time.time()
+        for _ in range(1000):
+            game.exec_move_idx(move, check_legal=False)
+            game.undo(allow_redo=False)
+        print("move and undo, tracker %-5s: %5.1f us" % (tracker is not None, 1e3 * (time.time() - tstart)))
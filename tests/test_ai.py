@@ -0,0 +1,142 @@
+import multiprocessing as mp
+import time
+import unittest
+from unittest import mock
+import numpy as np
+from quoridor import Quoridor
+from features import simple_value, simple_policy
+from ai import TranspositionTable, HeuristicOrdering, SearchStats, alphabeta_search, monte_carlo_tree_search, EXACT, \
+    LOWER, _alphabeta, _search_root_move
+
+# Worker order for delayed_search_root_move: the task of the 'slow' root move waits until that of the 'fast' one is
+# done. Worker processes are forked after it is set.
+_delay = {}
+
+
+def delayed_search_root_move(snapshot, mv, *args):
+    if mv == _delay['slow']:
+        _delay['done'].wait(timeout=30)
+    result = _search_root_move(snapshot, mv, *args)
+    if mv == _delay['fast']:
+        _delay['done'].set()
+    return result
+
+
+class TestTranspositionTable(unittest.TestCase):
+
+    def testReplacement(self):
+        tt = TranspositionTable(size=1)
+        tt.store('a', 3, 1.0, EXACT, 'e5')
+        # Shallower results for other keys go to the 'always-replace' slot...
+        tt.store('b', 1, 2.0, LOWER, 'e4')
+        tt.store('c', 2, 3.0, LOWER, 'e6')
+        self.assertEqual(tt.probe('a'), ('a', 3, 1.0, EXACT, 'e5'))
+        self.assertIsNone(tt.probe('b'))
+        self.assertEqual(tt.probe('c'), ('c', 2, 3.0, LOWER, 'e6'))
+        # ...and deeper ones take over the 'depth-preferred' slot.
+        tt.store('b', 4, 2.0, EXACT, 'e4')
+        self.assertIsNone(tt.probe('a'))
+        self.assertEqual(tt.probe('b')[1], 4)
+        self.assertEqual((tt.hits, tt.misses), (3, 2))
+
+
+class TestHeuristicOrdering(unittest.TestCase):
+
+    def testOrder(self):
+        game = Quoridor()
+        game.exec_move('b5')
+        game.exec_move('h5')
+        ordering = HeuristicOrdering()
+        ordering.cutoff('d4h', 2, 1)
+        ordering.cutoff('a1h', 1, 3)
+        ordering.cutoff('c6h', 1, 2)
+        moves = list(ordering.order(game, 1, 'e4v'))
+        # Table move, shortest-path step, killers for ply 1 (most recent first), then the wall with best history.
+        self.assertEqual(moves[:5], ['e4v', 'c5', 'c6h', 'a1h', 'd4h'])
+        self.assertEqual(sorted(moves[-3:]), ['a5', 'b4', 'b6'])
+        self.assertCountEqual(moves, game.all_legal_moves())
+
+
+class TestAlphaBeta(unittest.TestCase):
+
+    def testFindsWin(self):
+        game = Quoridor()
+        for mv0, mv1 in zip(['b5', 'c5', 'd5', 'e5', 'f5', 'g5', 'h5'], ['i4', 'h4', 'g4', 'f4', 'e4', 'd4', 'c4']):
+            game.exec_move(mv0)
+            game.exec_move(mv1)
+        tt, stats = TranspositionTable(), SearchStats()
+        self.assertEqual(alphabeta_search(game, simple_value, max_depth=0, tt=tt, stats=stats), 'i5')
+        self.assertEqual(stats.plies, 2)
+        self.assertGreater(stats.effective_branching_factor, 1.0)
+        self.assertEqual(len(game.history), 14)
+        # The root's best move is remembered for the next search.
+        self.assertEqual(tt.probe((game.hash_key(), game.current_player))[4], 'i5')
+
+    def testTimeBudget(self):
+        game = Quoridor()
+        for mv in ['b5', 'h5', 'c4h', 'g4h']:
+            game.exec_move(mv)
+        tstart = time.monotonic()
+        mv = alphabeta_search(game, simple_value, max_depth=10, time_budget_ms=200)
+        # Allow for the 1-ply iteration and for checking the deadline only between nodes.
+        self.assertLess(time.monotonic() - tstart, 1.0)
+        self.assertTrue(game.is_legal(mv))
+        self.assertEqual(len(game.history), 4)
+
+    def testParallel(self):
+        game = Quoridor()
+        for mv in ['b5', 'h5', 'c4h', 'g4h']:
+            game.exec_move(mv)
+        serial, parallel = SearchStats(), SearchStats()
+        mv = alphabeta_search(game, simple_value, max_depth=0, stats=serial)
+        self.assertEqual(alphabeta_search(game, simple_value, max_depth=0, n_workers=2, stats=parallel), mv)
+        self.assertEqual(parallel.plies, 2)
+        self.assertGreater(parallel.nodes, 0)
+        self.assertEqual(len(game.history), 4)
+
+    @unittest.skipUnless(mp.get_start_method() == 'fork', "workers must inherit the delayed task")
+    def testParallelTies(self):
+        game = Quoridor()
+        for mv in ['e4v', 'b4v', 'b5h', 'h3h', 'b5']:
+            game.exec_move(mv)
+        # Three walls tie for the best value here. The serial search plays the first of them in root move order.
+        root_moves = list(HeuristicOrdering().order(game, 0, None))
+        values = [_alphabeta(game, simple_value, 0, TranspositionTable(), HeuristicOrdering(), SearchStats(),
+                             root_moves=[mv])[0] for mv in root_moves]
+        ties = [mv for mv, v in zip(root_moves, values) if v == max(values)]
+        self.assertGreater(len(ties), 1)
+        self.assertNotEqual(ties[0], root_moves[0])
+        mv = alphabeta_search(game, simple_value, max_depth=0)
+        self.assertEqual(mv, ties[0])
+        # The last of them finishes first, so the first fails low against its value, and still has to be chosen.
+        _delay.update(slow=ties[0], fast=ties[-1], done=mp.Event())
+        with mock.patch('ai._search_root_move', delayed_search_root_move):
+            self.assertEqual(alphabeta_search(game, simple_value, max_depth=0, n_workers=2), mv)
+        self.assertEqual(len(game.history), 5)
+
+
+class TestMonteCarlo(unittest.TestCase):
+
+    def testParallelPlayouts(self):
+        game = Quoridor()
+        for mv in ['b5', 'h5', 'c4h']:
+            game.exec_move(mv)
+        mv = monte_carlo_tree_search(game, simple_value, simple_policy, max_depth=2, n_search=20, n_workers=2, seed=0)
+        self.assertTrue(game.is_legal(mv))
+        self.assertEqual(len(game.history), 3)
+
+    def testGlobalRandomState(self):
+        game = Quoridor()
+        game.exec_move('b5')
+        # Without a seed, a single process draws from the global random state, so np.random.seed still applies.
+        np.random.seed(4)
+        mv = monte_carlo_tree_search(game, simple_value, simple_policy, max_depth=2, n_search=20)
+        state = np.random.get_state()[1].copy()
+        np.random.seed(4)
+        self.assertEqual(monte_carlo_tree_search(game, simple_value, simple_policy, max_depth=2, n_search=20), mv)
+        self.assertTrue((np.random.get_state()[1] == state).all())
+        np.random.seed(4)
+        self.assertFalse((np.random.get_state()[1] == state).all())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import random
+import unittest
+from quoridor import Quoridor, IllegalMove
+from bitboard import BitboardQuoridor
+
+
+class TestBitboardQuoridor(unittest.TestCase):
+
+    def setUp(self):
+        self.game = BitboardQuoridor()
+
+    def testError1(self):
+        self.game.exec_move('h5h')
+        self.game.exec_move('h4v')
+        self.game.exec_move('a4')
+        with self.assertRaises(IllegalMove):
+            self.game.exec_move('h6v')
+
+    def testJumps(self):
+        for mv in ['b5', 'h5', 'c5', 'g5', 'd5', 'f5', 'e5']:
+            self.game.exec_move(mv)
+        # Player 1 at f5 faces player 0 at e5 and may jump straight over it.
+        self.assertIn('d5', self.game.all_legal_moves())
+        self.game.exec_move('d5h')
+        self.game.exec_move('a1h')
+        # With the straight jump blocked, player 1 may only jump diagonally.
+        moves = set(self.game.all_legal_moves())
+        self.assertNotIn('d5', moves)
+        self.assertIn('e4', moves)
+        self.assertIn('e6', moves)
+
+    def testMatchesQuoridor(self):
+        rng = random.Random(0)
+        for _ in range(3):
+            reference, game = Quoridor(), BitboardQuoridor()
+            for _ in range(60):
+                legal = reference.all_legal_moves()
+                self.assertCountEqual(legal, game.all_legal_moves())
+                self.assertCountEqual(reference.legal_action_indices(), game.legal_action_indices())
+                mv = rng.choice(sorted(legal))
+                reference.exec_move(mv)
+                game.exec_move(mv)
+                self.assertEqual(reference.walls, game.walls)
+                self.assertEqual(reference.players, game.players)
+                if reference.get_winner() is not None:
+                    self.assertEqual(reference.get_winner(), game.get_winner())
+                    break
+            start_key = BitboardQuoridor().hash_key()
+            while len(game.history) > 0:
+                game.undo()
+            self.assertEqual(start_key, game.hash_key())
+
+
+if __name__ == '__main__':
+    unittest.main()
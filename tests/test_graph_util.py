@@ -1,6 +1,6 @@
 import unittest
 from quoridor import create_adjacency_graph, WALL_CUTS
-from graph_util import PathGraph
+from graph_util import PathGraph, ArrayPathGraph, CutSetIndex
 
 
 class TestPathGraph(unittest.TestCase):
@@ -13,7 +13,7 @@ class TestPathGraph(unittest.TestCase):
         init_paths = self.pg._downhill.items()
         # Make a horizontal cut
         self.pg.cut([[(3, 4), (3, 5)]])
-        self.assertItemsEqual(init_paths, self.pg._downhill.items())
+        self.assertCountEqual(init_paths, self.pg._downhill.items())
 
     def testCutSidestep(self):
         init_dist = self.pg._dist[(4, 4)]
@@ -59,7 +59,7 @@ class TestPathGraph(unittest.TestCase):
         init_paths = self.pg._downhill.items()
         self.pg.cut([[(3, 3), (4, 3)], [(3, 4), (4, 4)]])
         self.pg.uncut([[(3, 3), (4, 3)], [(3, 4), (4, 4)]])
-        self.assertItemsEqual(init_paths, self.pg._downhill.items())
+        self.assertCountEqual(init_paths, self.pg._downhill.items())
 
     def testUncutEnclosed(self):
         # Make a bunch of cuts including closing off a space, then undo and assert that the graph
@@ -76,8 +76,100 @@ class TestPathGraph(unittest.TestCase):
             self.pg.cut([pair])
         for pair in reversed(pairs):
             self.pg.uncut([pair])
-            self.assertItemsEqual(prev_downhills.pop(), self.pg._downhill.items())
-            self.assertItemsEqual(prev_uphills.pop(), self.pg._downhill.items())
+            self.assertCountEqual(prev_downhills.pop(), self.pg._downhill.items())
+            self.assertCountEqual(prev_uphills.pop(), self.pg._downhill.items())
+
+    def testUncutRestoresPaths(self):
+        # With the journal, uncutting in reverse order restores exactly the previous paths (not just equally short
+        # ones), even when earlier cuts have rerouted the same nodes.
+        cuts = [WALL_CUTS[wall] for wall in ['e4h', 'e6h', 'd3v', 'e2h', 'c5v']]
+        snapshots = []
+        for pairs in cuts:
+            snapshots.append((dict(self.pg._dist.items()), dict(self.pg._downhill.items())))
+            self.pg.cut(pairs)
+        for pairs in reversed(cuts):
+            self.pg.uncut(pairs)
+            self.assertEqual(snapshots.pop(), (dict(self.pg._dist.items()), dict(self.pg._downhill.items())))
+
+    def testUncutOutOfOrder(self):
+        # Uncutting something other than the most recent cut falls back on searching for shorter paths.
+        self.pg.cut(WALL_CUTS['e4h'])
+        self.pg.cut(WALL_CUTS['e6h'])
+        self.pg.uncut(WALL_CUTS['e4h'])
+        self.pg.uncut(WALL_CUTS['e6h'])
+        fresh = type(self.pg)(create_adjacency_graph(), [(0, i) for i in range(9)])
+        for node in fresh._dist.keys():
+            self.assertEqual(fresh.get_distance(node), self.pg.get_distance(node))
+
+    def testJournalBounded(self):
+        # Only the most recent cuts are journaled. Older ones are still uncut correctly, by searching.
+        pg = type(self.pg)(create_adjacency_graph(), [(0, i) for i in range(9)], max_journal=2)
+        walls = ['e4h', 'e6h', 'd3v', 'c5v']
+        for wall in walls:
+            pg.cut(WALL_CUTS[wall])
+        self.assertEqual(len(pg._journal), 2)
+        for wall in reversed(walls):
+            pg.uncut(WALL_CUTS[wall])
+        fresh = type(self.pg)(create_adjacency_graph(), [(0, i) for i in range(9)])
+        for node in fresh._dist.keys():
+            self.assertEqual(fresh.get_distance(node), pg.get_distance(node))
+
+
+class TestArrayPathGraph(TestPathGraph):
+    """Run all of the PathGraph scenarios against ArrayPathGraph. ArrayPathGraph does not modify the adjacency dict it
+    is given, so self.graph is its live (read-only) view of the graph instead.
+    """
+
+    def setUp(self):
+        self.pg = ArrayPathGraph(create_adjacency_graph(), [(0, i) for i in range(9)])
+        self.graph = self.pg._graph
+
+    def testMatchesPathGraph(self):
+        pg = PathGraph(create_adjacency_graph(), [(0, i) for i in range(9)])
+        walls = ['c3h', 'c5h', 'e4v', 'f6h', 'f2v', 'b1v', 'g7h']
+        for wall in walls:
+            pg.cut(WALL_CUTS[wall])
+            self.pg.cut(WALL_CUTS[wall])
+            self.assertEqual(dict(pg._dist.items()), dict(self.pg._dist.items()))
+        for wall in reversed(walls):
+            pg.uncut(WALL_CUTS[wall])
+            self.pg.uncut(WALL_CUTS[wall])
+            self.assertEqual(dict(pg._dist.items()), dict(self.pg._dist.items()))
+
+
+class TestCutSetIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = create_adjacency_graph()
+        self.pg = PathGraph(self.graph, [(0, i) for i in range(9)])
+
+    def assertMatchesCut(self, node, pairs):
+        index = CutSetIndex(self.graph, [(0, i) for i in range(9)])
+        self.pg.cut(pairs)
+        expected = not self.pg.has_path(node)
+        self.pg.uncut(pairs)
+        self.assertEqual(expected, index.separates(node, pairs))
+
+    def testOpenBoard(self):
+        index = CutSetIndex(self.graph, [(0, i) for i in range(9)])
+        for pairs in WALL_CUTS.values():
+            self.assertFalse(index.separates((8, 4), pairs))
+
+    def testCloseBox(self):
+        # Wall (3, 4) and (3, 5) in on three sides. Closing the last side separates them, but nothing outside.
+        self.pg.cut([[(3, 4), (3, 3)], [(4, 4), (3, 4)], [(4, 5), (3, 5)], [(3, 6), (3, 5)]])
+        last_side = [[(2, 4), (3, 4)], [(2, 5), (3, 5)]]
+        for node in [(3, 4), (3, 5), (4, 4), (8, 8)]:
+            self.assertMatchesCut(node, last_side)
+        # Closing only half of the last side leaves a way out.
+        self.assertMatchesCut((3, 4), last_side[:1])
+
+    def testAllWalls(self):
+        for wall in ['c3h', 'c5h', 'e4v', 'f6h', 'f2v', 'd7v', 'b7h']:
+            self.pg.cut(WALL_CUTS[wall])
+        for pairs in WALL_CUTS.values():
+            for node in [(8, 4), (4, 4), (3, 6)]:
+                self.assertMatchesCut(node, pairs)
 
 if __name__ == '__main__':
     unittest.main()
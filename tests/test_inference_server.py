@@ -0,0 +1,82 @@
+import os
+import socket
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import torch
+from quoridor import Quoridor
+from quornn import encode_state_to_planes
+from inference_server import InferenceServer
+from mcts import MonteCarloTreeSearch
+
+
+def batch_pol_val_fun(planes):
+    # Deterministic, and different for every state: the policy depends on the pawn planes and the value on the walls.
+    policies = planes[:, [0, 2, 4]] * 2 + planes[:, [1]] / 10
+    return policies, planes[:, 4:].sum(dim=(1, 2, 3)) / 100
+
+
+def expected(game):
+    policies, values = batch_pol_val_fun(encode_state_to_planes(game, add_batch=True))
+    return policies[0], values[0].item()
+
+
+def positions():
+    games = []
+    for moves in [[], ['b5'], ['b5', 'h5', 'd4h'], ['a1h', 'h8v', 'e5h', 'c3v']]:
+        game = Quoridor()
+        for mv in moves:
+            game.exec_move(mv)
+        games.append(game)
+    return games
+
+
+def evaluate_all(pol_val_fun):
+    return [(policy, value) for (policy, value) in map(pol_val_fun, positions())]
+
+
+class TestInferenceServer(unittest.TestCase):
+
+    def assertResults(self, results):
+        for game, (policy, value) in zip(positions(), results):
+            expected_policy, expected_value = expected(game)
+            self.assertTrue(torch.allclose(policy, expected_policy))
+            self.assertAlmostEqual(value, expected_value, places=5)
+
+    def testClients(self):
+        with InferenceServer(batch_pol_val_fun, max_batch_size=4, max_wait_ms=5.0) as server:
+            client = server.client()
+            self.assertResults(evaluate_all(client))
+            # Threads of one process and other processes all get their own slots, and their requests are batched.
+            with ThreadPoolExecutor(4) as pool:
+                for results in pool.map(evaluate_all, [client] * 4):
+                    self.assertResults(results)
+            with ProcessPoolExecutor(3) as pool:
+                for results in pool.map(evaluate_all, [client] * 3):
+                    self.assertResults(results)
+            n_batches, n_states = server.stats()
+            self.assertEqual(n_states, 4 * (1 + 4 + 3))
+            self.assertLess(n_batches, n_states)
+
+    def testDisconnect(self):
+        with InferenceServer(batch_pol_val_fun, max_batch_size=2, max_wait_ms=200.0) as server:
+            # A client that disconnects while its request waits for a batch: its request is dropped, rather than
+            # evaluated in the slot that the next client is given.
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(os.path.join(server._dir, 'server.sock'))
+            conn.recv(2)
+            conn.sendall(b'\x01')
+            conn.close()
+            time.sleep(0.05)
+            self.assertResults(evaluate_all(server.client()))
+            self.assertEqual(server.stats()[1], 4)
+
+    def testSearch(self):
+        with InferenceServer(batch_pol_val_fun) as server:
+            mcts = MonteCarloTreeSearch(Quoridor(), server.client())
+            policy = mcts.search(n_evals=50)
+            self.assertAlmostEqual(policy.sum().item(), 1.0, places=5)
+            self.assertEqual(server.stats()[1], len(mcts._node_lookup))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import multiprocessing
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from quoridor import Quoridor
+from quornn import sample_action_index
+from mcts import MonteCarloTreeSearch, TreeNode, EvaluationCache
+
+
+def random_pol_val_fun(state):
+    return torch.rand(3, 9, 9), 2 * torch.rand(1) - 1
+
+
+def random_batch_pol_val_fun(planes):
+    return torch.rand(len(planes), 3, 9, 9), 2 * torch.rand(len(planes)) - 1
+
+
+class TestMonteCarloTreeSearch(unittest.TestCase):
+
+    def testBatchedSearch(self):
+        game = Quoridor()
+        mcts = MonteCarloTreeSearch(game, random_pol_val_fun, random_batch_pol_val_fun)
+        policy = mcts.search(n_evals=100, batch_size=16)
+        self.assertEqual(len(game.history), 0)
+        # Every simulation is backed up through the root exactly once, and all virtual losses have been removed.
+        store = mcts._store
+        self.assertEqual(store.count[store.edges(mcts._root._id)].sum(), 100)
+        self.assertAlmostEqual(policy.sum().item(), 1.0, places=5)
+        for node_id in mcts._node_lookup.values():
+            self.assertTrue((store.count[store.edges(node_id)] >= 0).all())
+            self.assertFalse(np.isnan(store.value[node_id]))
+
+    def assertTreeConsistent(self, mcts, exact):
+        store, root = mcts._store, mcts._root._id
+        reachable, stack, refs = {root}, [root], {root: 1}
+        while stack:
+            for child in TreeNode(store, stack.pop()).children().tolist():
+                refs[child] = refs.get(child, 0) + 1
+                if child not in reachable:
+                    reachable.add(child)
+                    stack.append(child)
+        live = set(mcts._node_lookup.values())
+        self.assertLessEqual(reachable, live)
+        self.assertEqual(len(live), store.size)
+        for node in live:
+            self.assertEqual(mcts._node_lookup[store.keys[node]], node)
+        if exact:
+            self.assertEqual(reachable, live)
+            for node in live:
+                self.assertEqual(store.refs[node], refs[node])
+
+    def testStepAndPrune(self):
+        for background in [False, True]:
+            game = Quoridor()
+            mcts = MonteCarloTreeSearch(game, random_pol_val_fun)
+            for _ in range(6):
+                policy = mcts.search(n_evals=200)
+                size = len(mcts._node_lookup)
+                mcts.step_and_prune(sample_action_index(policy, mcts.player, temperature=0.0), background=background)
+                mcts.wait_for_prune()
+                self.assertLess(len(mcts._node_lookup), size)
+                self.assertEqual(mcts._root._key, game.hash_key())
+                self.assertTreeConsistent(mcts, exact=False)
+            mcts.collect_garbage()
+            self.assertTreeConsistent(mcts, exact=True)
+
+    def testThreadedSearch(self):
+        game = Quoridor()
+        game.exec_move('e4h')
+        mcts = MonteCarloTreeSearch(game, random_pol_val_fun)
+        store = mcts._store
+        edge_capacity = len(store.action)
+        # Enough simulations for the store's arrays to grow while the threads run.
+        policy = mcts.search(n_evals=1200, n_threads=4)
+        self.assertEqual(len(game.history), 1)
+        self.assertGreater(len(store.action), edge_capacity)
+        self.assertEqual(store.count[store.edges(mcts._root._id)].sum(), 1200)
+        self.assertAlmostEqual(policy.sum().item(), 1.0, places=5)
+        for node_id in mcts._node_lookup.values():
+            self.assertTrue((store.count[store.edges(node_id)] >= 0).all())
+            self.assertFalse(np.isnan(store.value[node_id]))
+        self.assertTreeConsistent(mcts, exact=True)
+
+    def testRootParallelSearch(self):
+        game = Quoridor()
+        mcts = MonteCarloTreeSearch(game, random_pol_val_fun)
+        policy = mcts.search(n_evals=101, n_workers=2, seed=0)
+        self.assertEqual(len(game.history), 0)
+        # The workers' root statistics are merged into the root, and nothing else is added to the tree.
+        store = mcts._store
+        self.assertEqual(store.count[store.edges(mcts._root._id)].sum(), 101)
+        self.assertAlmostEqual(policy.sum().item(), 1.0, places=5)
+        self.assertEqual(len(mcts._node_lookup), 1)
+        # The tree can be stepped into a move that only the workers searched, and searched again from there.
+        action = sample_action_index(policy, mcts.player, temperature=0.0)
+        mcts.step_and_prune(action)
+        self.assertEqual(mcts._root._key, game.hash_key())
+        self.assertTreeConsistent(mcts, exact=True)
+        policy = mcts.search(n_evals=20, n_workers=2, seed=1)
+        self.assertEqual(store.count[store.edges(mcts._root._id)].sum(), 20)
+
+    def testBatchedSearchRequiresBatchFunction(self):
+        mcts = MonteCarloTreeSearch(Quoridor(), random_pol_val_fun)
+        with self.assertRaises(ValueError):
+            mcts.search(n_evals=10, batch_size=4)
+
+class CountingPolValFun(object):
+    def __init__(self):
+        self.n_calls = 0
+
+    def __call__(self, state):
+        self.n_calls += 1
+        return torch.full((3, 9, 9), float(state.current_player)), float(len(state.history))
+
+
+def cached_evaluations(cache, snapshots):
+    return [cache(Quoridor.from_snapshot(s))[1] for s in snapshots]
+
+
+class TestEvaluationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.games = []
+        for moves in [[], ['b5'], ['b5', 'h5'], ['d4h'], ['d4h', 'h5']]:
+            game = Quoridor()
+            for mv in moves:
+                game.exec_move(mv)
+            self.games.append(game)
+
+    def testHitsAndEviction(self):
+        fun = CountingPolValFun()
+        cache = EvaluationCache(fun, max_entries=3)
+        for game in self.games[:3] + self.games[:3]:
+            policy, value = cache(game)
+            self.assertTrue((policy == game.current_player).all())
+            self.assertEqual(value, len(game.history))
+        self.assertEqual((cache.hits, cache.misses, fun.n_calls), (3, 3, 3))
+        # Returned policies are copies.
+        cache(self.games[0])[0].fill_(5)
+        self.assertTrue((cache(self.games[0])[0] == 0).all())
+        # games[1] is now the least recently used entry.
+        cache(self.games[3])
+        self.assertEqual(len(cache), 3)
+        cache(self.games[1])
+        self.assertEqual(fun.n_calls, 5)
+        self.assertAlmostEqual(cache.hit_rate, 5 / 10)
+
+    def testByteLimit(self):
+        cache = EvaluationCache(CountingPolValFun(), max_bytes=2 * (243 * 4 + 8))
+        for game in self.games:
+            cache(game)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 2 * (243 * 4 + 8))
+
+    def testSearch(self):
+        cache = EvaluationCache(random_pol_val_fun)
+        MonteCarloTreeSearch(Quoridor(), cache).search(n_evals=50)
+        n_misses = cache.misses
+        MonteCarloTreeSearch(Quoridor(), cache).search(n_evals=50)
+        self.assertEqual(cache.misses, n_misses)
+        self.assertEqual(cache.hits, 51)
+
+    def testShared(self):
+        snapshots = [game.snapshot() for game in self.games]
+        with multiprocessing.Manager() as manager:
+            cache = EvaluationCache(CountingPolValFun(), shared=manager.dict())
+            self.assertEqual(cached_evaluations(cache, snapshots[:2]), [0, 1])
+            with ProcessPoolExecutor(2) as pool:
+                for values in pool.map(cached_evaluations, [cache] * 2, [snapshots] * 2):
+                    self.assertEqual(values, [0, 1, 2, 1, 2])
+            self.assertEqual(len(cache.shared), 5)
+            # The other processes' evaluations are now shared with this one.
+            self.assertEqual(cached_evaluations(cache, snapshots), [0, 1, 2, 1, 2])
+            self.assertEqual((cache.hits, cache.shared_hits, cache.misses), (2, 3, 2))
+
+if __name__ == '__main__':
+    unittest.main()
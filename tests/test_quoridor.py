@@ -1,7 +1,58 @@
+import random
 import unittest
 from quoridor import *
 
 
+def is_legal_pawn_slow(game, row, col):
+    """Same as game._is_legal_pawn, but works out adjacency and jumps directly from the adjacency graph, to test the
+    pawn-move tables against.
+    """
+    # Note: we cannot simply assert that the move is 1 space away due to possible jumping situations (at most 2
+    # spaces away in a 2-player game)
+    cur_loc = game.get_player()[0]
+    other_player_locs = set([p[0] for p in game.players])
+    adjacent_player_locs = other_player_locs & game._adjacency_graph[cur_loc]
+    # Check that another player is not in the position.
+    if (row, col) in adjacent_player_locs:
+        return False
+    # Check for jumping situation if there is another player adjacent to the current player
+    if len(adjacent_player_locs) > 0:
+        for (pr, pc) in adjacent_player_locs:
+            if pr == cur_loc[0]:
+                # Check horizontal jump (same row).
+                col_diff = pc - cur_loc[1]
+                one_further = (pr, pc + col_diff)
+                diagonals = [(pr - 1, pc), (pr + 1, pc)]
+                if one_further in game._adjacency_graph[(pr, pc)]:
+                    if (row, col) == one_further and one_further not in other_player_locs:
+                        return True
+                else:
+                    # The simple jump is blocked. Check diagonals.
+                    for d in diagonals:
+                        if (row, col) == d and d in game._adjacency_graph[(pr, pc)] \
+                                and d not in other_player_locs:
+                            return True
+            elif pc == cur_loc[1]:
+                # Check vertical jump (same col).
+                row_diff = pr - cur_loc[0]
+                one_further = (pr + row_diff, pc)
+                diagonals = [(pr, pc - 1), (pr, pc + 1)]
+                if one_further in game._adjacency_graph[(pr, pc)]:
+                    if (row, col) == one_further and one_further not in other_player_locs:
+                        return True
+                else:
+                    # The simple jump is blocked. Check diagonals.
+                    for d in diagonals:
+                        if (row, col) == d and d in game._adjacency_graph[(pr, pc)] \
+                                and d not in other_player_locs:
+                            return True
+    # Having considered jumps, check that target is adjacent to current position, taking
+    # into account walls.
+    if (row, col) not in game._adjacency_graph[cur_loc]:
+        return False
+    return True
+
+
 class TestQuoridor(unittest.TestCase):
 
     def setUp(self):
@@ -14,5 +65,107 @@ class TestQuoridor(unittest.TestCase):
         with self.assertRaises(IllegalMove) as context:
             self.game.exec_move('h6v')
 
+    def testActionIndices(self):
+        for mv in ['e5h', 'h5', 'a1v']:
+            self.game.exec_move_idx(ACTION_INDEX[mv])
+        self.assertEqual(self.game.history, ['e5h', ((8, 4), (7, 4)), 'a1v'])
+        self.assertCountEqual(self.game.legal_action_indices(),
+                              [ACTION_INDEX[mv] for mv in self.game.all_legal_moves()])
+        with self.assertRaises(IllegalMove):
+            self.game.exec_move_idx(ACTION_INDEX['e4h'])
+        for idx in range(N_ACTIONS):
+            self.assertEqual(PERSPECTIVE_INDEX[1][PERSPECTIVE_INDEX[1][idx]], idx)
+
+    def testZobristHash(self):
+        rng = random.Random(0)
+        keys = [self.game.hash_key()]
+        for _ in range(40):
+            self.game.exec_move(rng.choice(sorted(self.game.all_legal_moves())))
+            self.assertEqual(self.game.hash_key(), self.game._compute_zobrist())
+            keys.append(self.game.hash_key())
+        while len(self.game.history) > 0:
+            self.assertEqual(self.game.hash_key(), keys.pop())
+            self.game.undo()
+        self.assertEqual(self.game.hash_key(), keys.pop())
+
+    def testUndoIsPureRestore(self):
+        def snapshot(game):
+            return (set(game._open_walls), [dict(graph._downhill) for graph in game._pathgraphs])
+        rng = random.Random(1)
+        snapshots = []
+        for _ in range(40):
+            snapshots.append(snapshot(self.game))
+            mv = rng.choice(sorted(self.game.all_legal_moves()))
+            with self.game.temp_move(mv):
+                pass
+            self.assertEqual(snapshots[-1], snapshot(self.game))
+            self.game.exec_move(mv)
+        while len(self.game.history) > 0:
+            self.game.undo()
+            self.assertEqual(snapshots.pop(), snapshot(self.game))
+
+    def testStrictHash(self):
+        game = Quoridor(strict_hash=True)
+        self.assertEqual(game.hash_key(), (self.game.hash_key(), self.game.state_key()))
+        self.assertEqual(game, self.game)
+        game.exec_move('b5')
+        self.assertNotEqual(game, self.game)
+
+    def testPawnTables(self):
+        rng = random.Random(2)
+        for _ in range(10):
+            game = Quoridor()
+            while game.get_winner() is None and len(game.history) < 100:
+                for row in range(9):
+                    for col in range(9):
+                        self.assertEqual(game._is_legal_pawn(row, col), is_legal_pawn_slow(game, row, col))
+                game.exec_move(rng.choice(sorted(game.all_legal_moves())))
+            while len(game.history) > 0:
+                game.undo()
+            self.assertEqual(game._step_masks, INITIAL_STEP_MASKS)
+
+    def testIncrementalLegalWalls(self):
+        def brute_force(game):
+            return set(w for w in game._open_walls if w not in game._touched_walls or not game._blocks_path(w))
+        rng = random.Random(3)
+        for _ in range(5):
+            game = Quoridor()
+            expected = []
+            while game.get_winner() is None and len(game.history) < 100:
+                expected.append(brute_force(game))
+                self.assertEqual(set(game._get_legal_walls()[0]), expected[-1])
+                self.assertCountEqual(game._get_legal_walls()[1], [ACTION_INDEX[w] for w in expected[-1]])
+                game.exec_move(rng.choice(sorted(game.all_legal_moves())))
+            while len(game.history) > 0:
+                game.undo()
+                self.assertEqual(set(game._get_legal_walls()[0]), expected.pop())
+
+    def testIterLegalMoves(self):
+        rng = random.Random(4)
+        for _ in range(60):
+            moves = []
+            # Make and undo moves between steps, as a search would.
+            for mv in self.game.iter_legal_moves(key=str):
+                with self.game.temp_move(mv):
+                    moves.append(mv)
+            legal = self.game.all_legal_moves()
+            self.assertCountEqual(moves, legal)
+            self.assertCountEqual(self.game.iter_legal_moves(), legal)
+            walls = [mv for mv in moves if len(mv) == 3]
+            self.assertEqual(walls, sorted(walls))
+            self.game.exec_move(rng.choice(sorted(legal)))
+            if self.game.get_winner() is not None:
+                break
+
+    def testSnapshot(self):
+        rng = random.Random(5)
+        for _ in range(30):
+            self.game.exec_move(rng.choice(sorted(self.game.all_legal_moves())))
+        snapshot = self.game.snapshot()
+        self.assertEqual(len(snapshot), 30)
+        game = Quoridor.from_snapshot(snapshot)
+        self.assertEqual(game, self.game)
+        self.assertEqual(game.history, self.game.history)
+
 if __name__ == '__main__':
     unittest.main()
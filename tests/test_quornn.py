@@ -0,0 +1,121 @@
+import copy
+import pickle
+import random
+import unittest
+import torch
+from quoridor import Quoridor, parse_loc
+from quornn import encode_state_to_planes, encode_states_to_planes, PlaneTracker, encode_action_indices_to_masks, \
+    action_to_coordinate, flip_y_perspective
+
+
+def encode_state_to_planes_slow(game):
+    """Same as encode_state_to_planes, but sets the cells of each pawn and wall one at a time, to test the precomputed
+    cell tables against.
+    """
+    out = torch.zeros(6, 9, 9)
+    (cur_row, cur_col), cur_walls = game.players[game.current_player]
+    out[0, flip_y_perspective(cur_row, game.current_player), cur_col] = 1
+    out[1, :, :] = cur_walls
+    (other_row, other_col), other_walls = game.players[1-game.current_player]
+    out[2, flip_y_perspective(other_row, game.current_player), other_col] = 1
+    out[3, :, :] = other_walls
+    for w in game.walls:
+        (row, col) = parse_loc(w[:2])
+        if w[2] == 'h':
+            out[4, flip_y_perspective(row, game.current_player), col] = 1
+            out[4, flip_y_perspective(row, game.current_player), col+1] = 1
+        else:
+            out[5, flip_y_perspective(row, game.current_player, True), col] = 1
+            out[5, flip_y_perspective(row, game.current_player, True)+1, col] = 1
+    return out
+
+
+class TestEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.game = Quoridor()
+        for mv in ['a4', 'h5', 'a1v', 'd4h', 'h3v', 'h8v', 'b4']:
+            self.game.exec_move(mv)
+
+    def testEncodeState(self):
+        planes = encode_state_to_planes(self.game)
+        self.assertEqual(self.game.current_player, 1)
+        # Player 1 sees the board flipped: row r becomes row 8-r, and a vertical wall at row r covers rows 7-r and 8-r.
+        self.assertEqual(planes[0].nonzero().tolist(), [[8-7, 4]])
+        self.assertEqual(planes[2].nonzero().tolist(), [[8-1, 3]])
+        self.assertTrue((planes[1] == 8).all())
+        self.assertTrue((planes[3] == 8).all())
+        self.assertEqual(planes[4].nonzero().tolist(), [[8-3, 3], [8-3, 4]])
+        self.assertEqual(sorted(planes[5].nonzero().tolist()),
+                         [[0, 2], [0, 7], [1, 2], [1, 7], [7, 0], [8, 0]])
+
+    def testEncodeBatch(self):
+        rng = random.Random(3)
+        games = [Quoridor(), self.game]
+        for _ in range(6):
+            game = Quoridor()
+            for _ in range(rng.randrange(1, 30)):
+                game.exec_move(rng.choice(sorted(game.all_legal_moves())))
+            games.append(game)
+        expected = torch.stack([encode_state_to_planes_slow(g) for g in games])
+        self.assertTrue(torch.equal(encode_states_to_planes(games), expected))
+        compact = encode_states_to_planes(games, dtype=torch.uint8)
+        self.assertEqual(compact.dtype, torch.uint8)
+        self.assertTrue(torch.equal(compact.float(), expected))
+        out = torch.rand(len(games), 6, 9, 9)
+        self.assertIs(encode_states_to_planes(games, out=out), out)
+        self.assertTrue(torch.equal(out, expected))
+        for game, planes in zip(games, expected):
+            self.assertTrue(torch.equal(encode_state_to_planes(game), planes))
+
+    def testPlaneTracker(self):
+        rng = random.Random(0)
+        game, scratch = Quoridor(), Quoridor()
+        tracker = PlaneTracker(game)
+        for step in range(60):
+            if game.get_winner() is not None or rng.random() < 0.3 and len(game.history) > 0:
+                game.undo()
+                scratch.undo()
+            else:
+                mv = rng.choice(sorted(game.all_legal_moves()))
+                game.exec_move(mv)
+                scratch.exec_move(mv)
+            for player in range(2):
+                scratch.current_player = player
+                self.assertTrue(torch.equal(tracker.planes(player), encode_state_to_planes(scratch)))
+            scratch.current_player = game.current_player
+            self.assertTrue(torch.equal(encode_state_to_planes(game), encode_state_to_planes(scratch)))
+            self.assertTrue(torch.equal(encode_states_to_planes([scratch, game]),
+                                        encode_states_to_planes([scratch, scratch])))
+
+        # Copies of the game, as made by the driver for its AI threads, carry on tracking their own planes.
+        for game_copy in [copy.deepcopy(game), pickle.loads(pickle.dumps(game))]:
+            self.assertIsNot(game_copy.plane_tracker, tracker)
+            scratch_copy = copy.deepcopy(scratch)
+            for mv in sorted(game_copy.all_legal_moves())[:3]:
+                with game_copy.temp_move(mv), scratch_copy.temp_move(mv):
+                    expected = encode_state_to_planes(scratch_copy)
+                    self.assertTrue(torch.equal(encode_state_to_planes(game_copy), expected))
+                    self.assertTrue(torch.equal(game_copy.plane_tracker.planes(game_copy.current_player), expected))
+            self.assertTrue(torch.equal(encode_state_to_planes(game), encode_state_to_planes(scratch)))
+
+    def testLegalMasks(self):
+        rng = random.Random(1)
+        games = [Quoridor(), self.game]
+        for _ in range(4):
+            game = Quoridor()
+            for _ in range(rng.randrange(1, 20)):
+                game.exec_move(rng.choice(sorted(game.all_legal_moves())))
+            games.append(game)
+        masks = encode_action_indices_to_masks([g.legal_action_indices() for g in games],
+                                               [g.current_player for g in games])
+        self.assertEqual(masks.shape, (len(games), 3, 9, 9))
+        self.assertEqual(masks.dtype, torch.bool)
+        for game, mask in zip(games, masks):
+            expected = torch.zeros(3, 9, 9, dtype=torch.bool)
+            for mv in game.all_legal_moves():
+                expected[action_to_coordinate(mv, game.current_player)] = True
+            self.assertTrue(torch.equal(mask, expected))
+
+if __name__ == '__main__':
+    unittest.main()
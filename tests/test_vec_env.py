@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+from quoridor import Quoridor, IllegalMove, ACTION_INDEX, PERSPECTIVE_INDEX
+from vec_env import VecEnv
+
+
+class TestVecEnv(unittest.TestCase):
+
+    def testMatchesQuoridor(self):
+        n_games = 16
+        rng = np.random.default_rng(0)
+        env = VecEnv(n_games)
+        games = [Quoridor() for _ in range(n_games)]
+        for ply in range(120):
+            mask = env.legal_mask().reshape(n_games, -1)
+            perspective_mask = env.legal_mask(perspective=True).reshape(n_games, -1)
+            for b, game in enumerate(games):
+                self.assertEqual(env.winners()[b], -1 if game.get_winner() is None else game.get_winner())
+                if game.get_winner() is not None:
+                    self.assertFalse(mask[b].any())
+                    continue
+                self.assertCountEqual(np.flatnonzero(mask[b]), game.legal_action_indices())
+                self.assertCountEqual(np.flatnonzero(perspective_mask[b]),
+                                      [PERSPECTIVE_INDEX[game.current_player][i] for i in game.legal_action_indices()])
+                self.assertEqual(list(env.distances()[b]),
+                                 [graph.get_distance(p[0]) for graph, p in zip(game._pathgraphs, game.players)])
+            # Random legal actions, biased towards pawn moves so that some games finish.
+            scores = rng.random(mask.shape) * np.where(np.arange(mask.shape[1]) < 81, 3, 1)
+            actions = np.argmax(np.where(mask, scores, -1), axis=1)
+            for b, game in enumerate(games):
+                if game.get_winner() is None:
+                    game.exec_move_idx(int(actions[b]))
+            env.step(actions, check_legal=True)
+        self.assertTrue((env.winners() >= 0).any())
+
+    def testReset(self):
+        env = VecEnv(2)
+        env.step([ACTION_INDEX['b5'], ACTION_INDEX['e4h']])
+        env.reset([1])
+        self.assertEqual(env.pawns.tolist(), [[13, 76], [4, 76]])
+        self.assertFalse(env.walls[1].any())
+        self.assertEqual(env.current_player.tolist(), [1, 0])
+
+    def testIllegal(self):
+        env = VecEnv(2)
+        with self.assertRaises(IllegalMove):
+            env.step([ACTION_INDEX['b5'], ACTION_INDEX['c5']], check_legal=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,337 @@
+import numpy as np
+from quoridor import BOARD_SIZE, IllegalMove, INITIAL_STEP_MASKS, PERSPECTIVE_INDEX, STEP_OFFSETS, PERPENDICULAR_STEPS
+
+# Squares are numbered row * BOARD_SIZE + col and actions are numbered as in quoridor.ACTION_INDEX, i.e. flat indices
+# into a (3, 9, 9) array with the same layout as quornn.POLICY_SHAPE: pawn moves on plane 0, horizontal walls on plane
+# 1 and vertical walls on plane 2, in board coordinates.
+N_SQUARES = BOARD_SIZE * BOARD_SIZE
+N_WALL_SLOTS = BOARD_SIZE - 1
+START_SQUARES = (BOARD_SIZE // 2, N_SQUARES - BOARD_SIZE // 2 - 1)
+GOAL_ROWS = (BOARD_SIZE - 1, 0)
+N_WALLS = 10
+
+# Step masks use the bits of quoridor.PAWN_STEPS: bit 0 up, 1 down, 2 left and 3 right.
+UP, DOWN, LEFT, RIGHT = 1, 2, 4, 8
+PERSPECTIVE_INDEX_ARRAY = np.array(PERSPECTIVE_INDEX)
+# Bit of each column when a row of the board is packed into a uint16, and the mask of a full row.
+COL_BITS = (1 << np.arange(BOARD_SIZE)).astype(np.uint16)
+ROW_MASK = np.uint16((1 << BOARD_SIZE) - 1)
+
+
+class VecEnv(object):
+    """A batch of B independent 2-player games of Quoridor held as numpy arrays, so that one ply of all B games costs a
+    fixed number of array operations rather than B calls into Quoridor objects.
+
+    State:
+        pawns           (B, 2) square of each player's pawn
+        wall_counts     (B, 2) walls remaining to each player
+        current_player  (B,) player to move
+        walls           (B, 2, 8, 8) bitplanes of placed horizontal (plane 0) and vertical (plane 1) walls, indexed by
+                        the wall's top-left square as in the move notation
+        step_masks      (B, 81) which steps a pawn may take from each square (see quoridor.PAWN_STEPS)
+        open_right      (B, 9) the same for steps to the right, as a bitmask of columns for each row
+        open_down       (B, 9) the same for steps down
+        distance_maps   (B, 2, 81) distance from each square to each player's goal row
+        winner          (B,) index of the winning player, or -1
+
+    Games that have ended are frozen: step() ignores their actions until they are reset().
+    """
+
+    def __init__(self, n_games):
+        self.n_games = n_games
+        self.pawns = np.zeros((n_games, 2), dtype=np.int64)
+        self.wall_counts = np.zeros((n_games, 2), dtype=np.int64)
+        self.current_player = np.zeros(n_games, dtype=np.int64)
+        self.walls = np.zeros((n_games, 2, N_WALL_SLOTS, N_WALL_SLOTS), dtype=bool)
+        self.step_masks = np.zeros((n_games, N_SQUARES), dtype=np.uint8)
+        self.open_right = np.zeros((n_games, BOARD_SIZE), dtype=np.uint16)
+        self.open_down = np.zeros((n_games, BOARD_SIZE), dtype=np.uint16)
+        self.distance_maps = np.zeros((n_games, 2, N_SQUARES), dtype=np.int16)
+        self.winner = np.zeros(n_games, dtype=np.int64)
+        self.reset()
+
+    def reset(self, games=None):
+        """Reset all games, or just those selected by 'games' (an index or boolean array), to the starting position.
+        """
+        if games is None:
+            games = slice(None)
+        self.pawns[games] = START_SQUARES
+        self.wall_counts[games] = N_WALLS
+        self.current_player[games] = 0
+        self.walls[games] = False
+        self.step_masks[games] = INITIAL_STEP_MASKS
+        self.open_right[games] = ROW_MASK >> 1
+        self.open_down[games] = [ROW_MASK] * (BOARD_SIZE - 1) + [0]
+        self.winner[games] = -1
+        self._update_distances(np.arange(self.n_games)[games])
+
+    def step(self, actions, check_legal=False):
+        """Play one move in every game, given by the (B,) array of action indices 'actions' in board coordinates.
+
+        Actions of games that have already ended are ignored. If check_legal is False, the actions are assumed to be
+        legal (for example because they were sampled from legal_mask()); otherwise an IllegalMove exception is raised
+        if any of them is not.
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        games = np.flatnonzero(self.winner < 0)
+        actions = actions[games]
+        if check_legal:
+            legal = self.legal_mask().reshape(self.n_games, -1)[games, actions]
+            if not legal.all():
+                raise IllegalMove(actions[~legal])
+        players = self.current_player[games]
+
+        # Pawn moves.
+        is_pawn = actions < N_SQUARES
+        self.pawns[games[is_pawn], players[is_pawn]] = actions[is_pawn]
+
+        # Walls: set the wall bit, use up one of the player's walls, and close the steps across the wall.
+        wall_games, wall_players = games[~is_pawn], players[~is_pawn]
+        plane, row, col = actions[~is_pawn] // N_SQUARES - 1, (actions[~is_pawn] // BOARD_SIZE) % BOARD_SIZE, \
+            actions[~is_pawn] % BOARD_SIZE
+        self.walls[wall_games, plane, row, col] = True
+        self.wall_counts[wall_games, wall_players] -= 1
+        top_left = row * BOARD_SIZE + col
+        is_h = plane == 0
+        # A horizontal wall separates top_left and its right neighbor from the squares below them. A vertical wall
+        # separates top_left and the square below it from the squares to their right.
+        second = np.where(is_h, top_left + 1, top_left + BOARD_SIZE)
+        across = np.where(is_h, BOARD_SIZE, 1)
+        out_bit = np.where(is_h, DOWN, RIGHT).astype(np.uint8)
+        in_bit = np.where(is_h, UP, LEFT).astype(np.uint8)
+        for sq in (top_left, second):
+            self.step_masks[wall_games, sq] &= ~out_bit
+            self.step_masks[wall_games, sq + across] &= ~in_bit
+        h_games, v_games = wall_games[is_h], wall_games[~is_h]
+        self.open_down[h_games, row[is_h]] &= ~(COL_BITS[col[is_h]] | COL_BITS[col[is_h] + 1])
+        self.open_right[v_games, row[~is_h]] &= ~COL_BITS[col[~is_h]]
+        self.open_right[v_games, row[~is_h] + 1] &= ~COL_BITS[col[~is_h]]
+        self._update_distances(wall_games)
+
+        # Check for winners, then pass the turn.
+        rows = self.pawns[games, players] // BOARD_SIZE
+        won = rows == np.array(GOAL_ROWS)[players]
+        self.winner[games[won]] = players[won]
+        self.current_player[games] = 1 - players
+
+    def winners(self):
+        """Return the (B,) array of winning players, with -1 for games that have not ended.
+        """
+        return self.winner.copy()
+
+    def distances(self):
+        """Return the (B, 2) array of each player's shortest-path distance to their goal.
+        """
+        return self.distance_maps[np.arange(self.n_games)[:, None], [0, 1], self.pawns]
+
+    def legal_mask(self, perspective=False):
+        """Return a (B, 3, 9, 9) boolean array of the legal actions of the player to move in each game. Ended games
+        have no legal actions.
+
+        By default the mask is in board coordinates, like the actions taken by step(). If 'perspective' is True, it is
+        instead oriented to the perspective of the player to move, like the policy planes of quornn.
+        """
+        mask = np.zeros((self.n_games, 3, BOARD_SIZE, BOARD_SIZE), dtype=bool)
+        mask[:, 0] = self._pawn_mask().reshape(self.n_games, BOARD_SIZE, BOARD_SIZE)
+        has_walls = self.wall_counts[np.arange(self.n_games), self.current_player] > 0
+        mask[:, 1:, :N_WALL_SLOTS, :N_WALL_SLOTS] = self._wall_mask() & has_walls[:, None, None, None]
+        mask[self.winner >= 0] = False
+        mask = mask.reshape(self.n_games, -1)
+        if perspective:
+            mask = np.take_along_axis(mask, PERSPECTIVE_INDEX_ARRAY[self.current_player], axis=1)
+        return mask.reshape(self.n_games, 3, BOARD_SIZE, BOARD_SIZE)
+
+    ####################
+    # HELPER FUNCTIONS #
+    ####################
+
+    def _pawn_mask(self):
+        """Return the (B, 81) boolean array of squares the player to move may move their pawn to, including jumps.
+        """
+        games = np.arange(self.n_games)
+        own = self.pawns[games, self.current_player]
+        other = self.pawns[games, 1 - self.current_player]
+        own_steps, other_steps = self.step_masks[games, own], self.step_masks[games, other]
+        mask = np.zeros((self.n_games, N_SQUARES), dtype=bool)
+        for d in range(4):
+            can_step = (own_steps >> d) & 1 == 1
+            target = own + STEP_OFFSETS[d]
+            onto_other = can_step & (target == other)
+            # Plain steps onto empty squares.
+            plain = can_step & ~onto_other
+            mask[games[plain], target[plain]] = True
+            # Straight jump over the other pawn.
+            straight = onto_other & ((other_steps >> d) & 1 == 1)
+            mask[games[straight], (other + STEP_OFFSETS[d])[straight]] = True
+            # The simple jump is blocked. Jump diagonally instead.
+            blocked = onto_other & ~straight
+            for side in PERPENDICULAR_STEPS[d]:
+                diagonal = blocked & ((other_steps >> side) & 1 == 1)
+                mask[games[diagonal], (other + STEP_OFFSETS[side])[diagonal]] = True
+        return mask
+
+    def _wall_mask(self):
+        """Return the (B, 2, 8, 8) boolean array of wall placements that neither overlap a placed wall nor cut off some
+        player from their goal, ignoring whether the player to move has a wall left.
+        """
+        h, v = self.walls[:, 0], self.walls[:, 1]
+        # Walls overlap walls of the same orientation one slot along their length, and cross those of the other
+        # orientation in the same slot.
+        h_open = ~(h | v | _shift(h, 0, 1) | _shift(h, 0, -1))
+        v_open = ~(h | v | _shift(v, 1, 0) | _shift(v, -1, 0))
+        legal = np.stack([h_open, v_open], axis=1)
+
+        # A wall can only cut off a region of the board if it closes a loop of walls and board edges, which needs at
+        # least two of its three points (both ends and the middle) to already touch a wall or the edge. Only those
+        # are checked with a flood fill.
+        lattice = np.zeros((self.n_games, BOARD_SIZE + 1, BOARD_SIZE + 1), dtype=np.int8)
+        lattice[:, [0, -1], :] = 1
+        lattice[:, :, [0, -1]] = 1
+        for k in range(3):
+            lattice[:, 1:BOARD_SIZE, k:k + N_WALL_SLOTS] |= h
+            lattice[:, k:k + N_WALL_SLOTS, 1:BOARD_SIZE] |= v
+        h_contacts = sum(lattice[:, 1:BOARD_SIZE, k:k + N_WALL_SLOTS] for k in range(3))
+        v_contacts = sum(lattice[:, k:k + N_WALL_SLOTS, 1:BOARD_SIZE] for k in range(3))
+        contacts = np.stack([h_contacts, v_contacts], axis=1)
+        games, plane, row, col = np.nonzero(legal & (contacts >= 2))
+        if len(games) > 0:
+            legal[games, plane, row, col] = ~self._blocks_path(games, plane, row, col)
+        return legal
+
+    def _blocks_path(self, games, plane, row, col):
+        """For each (game, wall) pair given by the equal-length arrays of game indices, wall planes (0 for horizontal)
+        and wall rows and columns, return whether placing the wall would cut off either player from their goal.
+        """
+        right, down = self.open_right[games], self.open_down[games]
+        # Cut the steps across each wall.
+        pairs = np.arange(len(games))
+        is_h = plane == 0
+        bits = COL_BITS[col] | np.where(is_h, COL_BITS[col + 1], 0).astype(np.uint16)
+        down[pairs[is_h], row[is_h]] &= ~bits[is_h]
+        right[pairs[~is_h], row[~is_h]] &= ~bits[~is_h]
+        right[pairs[~is_h], row[~is_h] + 1] &= ~bits[~is_h]
+        # Flood fill from both pawns at once.
+        right, down = np.concatenate([right, right]), np.concatenate([down, down])
+        pawns = np.concatenate([self.pawns[games, 0], self.pawns[games, 1]])
+        reach = np.zeros((len(pawns), BOARD_SIZE), dtype=np.uint16)
+        reach[np.arange(len(pawns)), pawns // BOARD_SIZE] = COL_BITS[pawns % BOARD_SIZE]
+        reached = _reaches_row(reach, right, down, np.repeat(GOAL_ROWS, len(games)))
+        return ~(reached[:len(games)] & reached[len(games):])
+
+    def _update_distances(self, games):
+        """Recompute distance_maps of the given games by a breadth-first search out from each goal row.
+        """
+        if len(games) == 0:
+            return
+        right, down = self.open_right[games], self.open_down[games]
+        right, down = np.concatenate([right, right]), np.concatenate([down, down])
+        n = len(games)
+        frontier = np.zeros((2 * n, BOARD_SIZE), dtype=np.uint16)
+        frontier[:n, GOAL_ROWS[0]] = ROW_MASK
+        frontier[n:, GOAL_ROWS[1]] = ROW_MASK
+        distances = np.full((2 * n, BOARD_SIZE, BOARD_SIZE), -1, dtype=np.int16)
+        visited = frontier.copy()
+        distance = 0
+        while frontier.any():
+            distances[((frontier[:, :, None] & COL_BITS) != 0)] = distance
+            frontier = _expand(frontier, right, down) & ~visited
+            visited |= frontier
+            distance += 1
+        distances = distances.reshape(2, n, N_SQUARES)
+        self.distance_maps[games, 0] = distances[0]
+        self.distance_maps[games, 1] = distances[1]
+
+
+def _shift(planes, d_row, d_col):
+    """Return a copy of the (B, 8, 8) boolean array 'planes' shifted by (d_row, d_col), filling in with False.
+    """
+    out = np.zeros_like(planes)
+    rows, cols = planes.shape[1:]
+    out[:, max(d_row, 0):rows + min(d_row, 0), max(d_col, 0):cols + min(d_col, 0)] = \
+        planes[:, max(-d_row, 0):rows + min(-d_row, 0), max(-d_col, 0):cols + min(-d_col, 0)]
+    return out
+
+
+def _expand(reach, right, down):
+    """Return the squares one step away from those in 'reach', where all three arguments are (N, 9) uint16 row bitmasks
+    and right and down are rows of VecEnv.open_right and VecEnv.open_down.
+    """
+    out = ((reach & right) << 1) | ((reach >> 1) & right)
+    out[:, 1:] |= reach[:, :-1] & down[:, :-1]
+    out[:, :-1] |= reach[:, 1:] & down[:, :-1]
+    return out
+
+
+def _spread(reach, right, down):
+    """Return the squares reachable from those in 'reach' by running straight along rows, then straight along columns
+    (see _expand for the arguments). Each run is a Kogge-Stone fill, taking 4 shifts to cover up to 8 steps.
+    """
+    # Right, where 'open' bit c means a run may continue from column c to c + s, then left.
+    gen, open_ = reach, right
+    for s in (1, 2, 4, 8):
+        gen = gen | ((gen & open_) << s)
+        open_ = open_ & (open_ >> s)
+    open_ = right << 1
+    for s in (1, 2, 4, 8):
+        gen = gen | ((gen & open_) >> s)
+        open_ = open_ & (open_ << s)
+    # Down, where 'open' row r means a run may continue from row r to r + s, then up.
+    gen, open_ = gen.copy(), down.copy()
+    for s in (1, 2, 4, 8):
+        gen[:, s:] |= gen[:, :-s] & open_[:, :-s]
+        open_[:, :-s] &= open_[:, s:]
+        open_[:, -s:] = 0
+    open_ = np.zeros_like(down)
+    open_[:, 1:] = down[:, :-1]
+    for s in (1, 2, 4, 8):
+        gen[:, :-s] |= gen[:, s:] & open_[:, s:]
+        open_[:, s:] &= open_[:, :-s]
+        open_[:, :s] = 0
+    return gen
+
+
+def _reaches_row(reach, right, down, rows):
+    """Return a boolean array of whether a pawn can get from the squares in each row of 'reach' to the matching entry of
+    'rows' (see _expand for the arguments). Each flood fill stops as soon as it reaches its row or stops growing.
+    """
+    result = np.zeros(len(reach), dtype=bool)
+    active = np.arange(len(reach))
+    while len(active) > 0:
+        spread = _spread(reach, right, down)
+        reached = spread[np.arange(len(active)), rows] != 0
+        result[active[reached]] = True
+        keep = ~reached & (spread != reach).any(axis=1)
+        active, reach, right, down, rows = active[keep], spread[keep], right[keep], down[keep], rows[keep]
+    return result
+
+
+if __name__ == '__main__':
+    # Time random playouts of a batch of games against the same playouts one Quoridor object at a time.
+    import time
+    from quoridor import Quoridor
+
+    n_games, n_plies = 1000, 50
+    rng = np.random.default_rng(0)
+    env = VecEnv(n_games)
+    tstart = time.time()
+    for ply in range(n_plies):
+        mask = env.legal_mask().reshape(n_games, -1)
+        # Sample a legal action per game by taking the argmax of random scores over the legal ones.
+        actions = np.argmax(np.where(mask, rng.random(mask.shape), -1), axis=1)
+        env.step(actions)
+    elapsed = time.time() - tstart
+    print("VecEnv: %d games x %d plies in %.2fs (%.1f us per game-ply)" %
+          (n_games, n_plies, elapsed, 1e6 * elapsed / (n_games * n_plies)))
+
+    n_games = 20
+    tstart = time.time()
+    for _ in range(n_games):
+        game = Quoridor()
+        for ply in range(n_plies):
+            if game.get_winner() is not None:
+                break
+            legal = game.legal_action_indices()
+            game.exec_move_idx(legal[rng.integers(len(legal))], check_legal=False)
+    elapsed = time.time() - tstart
+    print("Quoridor: %d games x %d plies in %.2fs (%.1f us per game-ply)" %
+          (n_games, n_plies, elapsed, 1e6 * elapsed / (n_games * n_plies)))